@@ -1,18 +1,204 @@
 from __future__ import division
-from pykalman import AdditiveUnscentedKalmanFilter
 import numpy as np
-import numpy.linalg as la
 
-def AFK(y):
-	#Inputs: GPS coordinates; nx2 vector
-	#Outputs: smoothed states; nx2 vector
+# SUMMARY
+#--------------------
+# Linear constant-velocity Kalman filter and Rauch-Tung-Striebel smoother for
+# GPS positions. Each coordinate column is an independent [position, velocity]
+# state with the same noise model, so the 2x2 covariances and gains don't
+# depend on the data: they are computed once per time step and shared by all
+# columns.
+#
+# Noise model (alpha is the same smoothness knob as in the old UKF version:
+# process noise relative to measurement noise, smaller is smoother):
+#   R = obs_var                                             measurement noise of a position
+#   Q = alpha * obs_var * [[dt^3/3, dt^2/2], [dt^2/2, dt]]  white-noise acceleration
+#
+# Only the covariance recursion runs step by step. With the gains known, the
+# filtered and the smoothed states are affine recurrences x_k = A_k x_{k-1} + b_k
+# over (2, d) state arrays, solved for all steps at once by a blocked prefix
+# scan (_affine_scan) of batched 2x2 products.
+#
+# Batch:     kalman_filter(y), smooth(y), AFK(y)
+# Streaming: f = KalmanFilter(); f.update(position) for every fix
 
-	def TransObsFunc(state): #Same functions for simplified filter
-    	return state
+ALPHA = 0.8
+OBS_VAR = 1.0
+INIT_VEL_VAR = 1e4   # variance of the unknown initial velocity, relative to obs_var
+STEADY_RTOL = 1e-15  # covariances this close to the last step's count as converged
+SCAN_BLOCK = 64      # steps per block of _affine_scan
 
-	alpha = 0.8 #Tuning parameter for smoothness
-	akf = AdditiveUnscentedKalmanFilter(
-	    TransObsFunc, TransObsFunc,
-	    np.eye(2)*alpha, np.eye(2),
-	    [y[0,0], y[0,1]], np.eye(2))
-	return akf.filter(y)[0]
+def _predict(P, dt, q):
+    # Covariance prediction P = F P F' + Q with F = [[1, dt], [0, 1]]
+    p00, p01, p11 = P
+    p00 = p00 + 2*dt*p01 + dt*dt*p11 + q*dt**3/3
+    p01 = p01 + dt*p11 + q*dt*dt/2
+    p11 = p11 + q*dt
+    return (p00, p01, p11)
+
+def _correct(P, r):
+    # Covariance update with H = [1, 0]; returns the updated covariance and the gain
+    p00, p01, p11 = P
+    s = p00 + r
+    k0, k1 = p00/s, p01/s
+    return (p00 - k0*p00, p01 - k0*p01, p11 - k1*p01), (k0, k1)
+
+def _time_steps(n, dt):
+    return np.broadcast_to(np.asarray(dt, dtype=np.float64), (max(n-1, 0),)).copy()
+
+def _transitions(steps):
+    # F_k = [[1, dt_k], [0, 1]] of every step, (n-1, 2, 2)
+    F = np.zeros((len(steps), 2, 2))
+    F[:, 0, 0] = F[:, 1, 1] = 1.0
+    F[:, 0, 1] = steps
+    return F
+
+def _gains(alpha, obs_var, steps):
+    """
+    Filter gains (n-1, 2) and the predicted (n-1, 3) and filtered (n, 3)
+    covariances [p00, p01, p11] of every step. The Riccati recursion is the
+    one sequential part; it runs on plain floats. With a constant time step
+    the covariances converge, and the remaining steps repeat the steady state.
+    """
+    r = obs_var
+    q = alpha*obs_var
+    # The first fix fixes the position, the velocity is unknown
+    P = (r, 0.0, INIT_VEL_VAR*obs_var)
+    gains, predicted, filtered = [], [], [P]
+    constant = len(steps) > 0 and np.all(steps == steps[0])
+    for step in steps.tolist():
+        P = _predict(P, step, q)
+        predicted.append(P)
+        P, gain = _correct(P, r)
+        gains.append(gain)
+        converged = constant and all(abs(a - b) <= STEADY_RTOL*abs(b) for a, b in zip(P, filtered[-1]))
+        filtered.append(P)
+        if converged:
+            break
+    rest = len(steps) - len(gains)
+    return _repeat_last(gains, 2, rest), _repeat_last(predicted, 3, rest), _repeat_last(filtered, 3, rest)
+
+def _repeat_last(rows, width, count):
+    rows = np.array(rows, dtype=np.float64).reshape(-1, width)
+    return np.concatenate((rows, np.repeat(rows[-1:], count, axis=0))) if count else rows
+
+def _smoother_gains(steps, predicted, filtered):
+    # Smoother gains G_k = P_k F_k' P_{k+1|k}^-1, (n-1, 2, 2)
+    p00, p01, p11 = filtered[:-1].T
+    a00, a01, a11 = predicted.T
+    c00, c01 = p00 + steps*p01, p01
+    c10, c11 = p01 + steps*p11, p11
+    det = a00*a11 - a01*a01
+    return np.stack((np.stack(((c00*a11 - c01*a01)/det, (c01*a00 - c00*a01)/det), axis=-1),
+                     np.stack(((c10*a11 - c11*a01)/det, (c11*a00 - c10*a01)/det), axis=-1)), axis=1)
+
+def _affine_scan(A, b, x0):
+    """
+    All states of x_k = A[k-1] x_{k-1} + b[k-1] for k = 1..n-1, from x_0:
+    A is (n-1, 2, 2), b and x0 are (n-1, 2, d) and (2, d). Returns (n, 2, d).
+    Steps are grouped in blocks of SCAN_BLOCK. Within all blocks at once, a
+    Hillis-Steele scan composes the maps: after the pass with shift s, every
+    entry is the composition of the (up to) 2s maps ending at it. The last
+    state of each block then carries into the next one.
+    """
+    n = len(b) + 1
+    blocks = -(-n // SCAN_BLOCK)
+    # padded with identity maps, which leave the last state unchanged
+    A = np.concatenate((np.zeros((1, 2, 2)), A, np.broadcast_to(np.eye(2), (blocks*SCAN_BLOCK - n, 2, 2))))
+    b = np.concatenate((x0[np.newaxis], b, np.zeros((blocks*SCAN_BLOCK - n,) + x0.shape)))
+    A = A.reshape(blocks, SCAN_BLOCK, 2, 2)
+    b = b.reshape((blocks, SCAN_BLOCK) + x0.shape)
+    s = 1
+    while s < SCAN_BLOCK:
+        b[:, s:] = A[:, s:] @ b[:, :-s] + b[:, s:]
+        A[:, s:] = A[:, s:] @ A[:, :-s]
+        s *= 2
+    last = [b[0, -1]]
+    for k in range(1, blocks):
+        last.append(A[k, -1] @ last[-1] + b[k, -1])
+    if blocks > 1:
+        b[1:] += A[1:] @ np.stack(last[:-1])[:, np.newaxis]
+    return b.reshape((-1,) + x0.shape)[:n]
+
+def _filter_states(z, steps, gains):
+    """
+    Filtered [position, velocity] states (n, 2, d) of the fixes z (n, d):
+    x_k = (I - K_k H) F_k x_{k-1} + K_k z_k.
+    """
+    K = gains[:, :, np.newaxis]
+    A = _transitions(steps)
+    A = A - K * A[:, np.newaxis, 0, :]  # (I - K H) F: H F is the first row of F
+    x0 = np.stack((z[0], np.zeros_like(z[0])))
+    return _affine_scan(A, K * z[1:, np.newaxis, :], x0)
+
+def _smooth_states(x, steps, smoother_gains):
+    """
+    RTS pass over the filtered states x (n, 2, d), last step first:
+    s_k = x_k + G_k (s_{k+1} - F_k x_k) = G_k s_{k+1} + (I - G_k F_k) x_k.
+    """
+    G = smoother_gains
+    b = x[:-1] - G @ _transitions(steps) @ x[:-1]
+    return _affine_scan(G[::-1], b[::-1], x[-1])[::-1]
+
+# The fixes as an (n, d) array of offsets from the first one, which keeps the
+# magnitudes (EPSG:3857 coordinates are ~1e7 m) out of the scan's products
+def _columns(y):
+    z = y.reshape(len(y), -1)
+    return z - z[0], z[0]
+
+def kalman_filter(y, alpha=ALPHA, obs_var=OBS_VAR, dt=1.0):
+    """
+    Filtered positions of the fixes y (n x d array, e.g. projected x/y), each
+    using only the fixes up to it. dt is the time between fixes, a scalar or
+    an array of n-1 steps.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) == 0:
+        return y.copy()
+    z, origin = _columns(y)
+    steps = _time_steps(len(y), dt)
+    gains = _gains(alpha, obs_var, steps)[0]
+    return (_filter_states(z, steps, gains)[:, 0] + origin).reshape(y.shape)
+
+def smooth(y, alpha=ALPHA, obs_var=OBS_VAR, dt=1.0):
+    """Rauch-Tung-Striebel smoothed positions: every position uses the whole trace."""
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) == 0:
+        return y.copy()
+    z, origin = _columns(y)
+    steps = _time_steps(len(y), dt)
+    gains, predicted, filtered = _gains(alpha, obs_var, steps)
+    states = _smooth_states(_filter_states(z, steps, gains), steps, _smoother_gains(steps, predicted, filtered))
+    return (states[:, 0] + origin).reshape(y.shape)
+
+def AFK(y, alpha=ALPHA):
+    # Inputs: GPS coordinates; nx2 vector
+    # Outputs: filtered positions; nx2 vector
+    return kalman_filter(y, alpha)
+
+
+class KalmanFilter(object):
+    """Streaming version of kalman_filter(): one update() per fix."""
+
+    def __init__(self, alpha=ALPHA, obs_var=OBS_VAR):
+        self.alpha = alpha
+        self.obs_var = obs_var
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.P = None
+
+    def update(self, position, dt=1.0):
+        """Add one fix (a length-d position); returns its filtered position."""
+        z = np.asarray(position, dtype=np.float64)
+        if self.x is None:
+            self.x = np.stack((z, np.zeros_like(z)))
+            self.P = (self.obs_var, 0.0, INIT_VEL_VAR*self.obs_var)
+            return z.copy()
+        self.P = _predict(self.P, dt, self.alpha*self.obs_var)
+        self.P, (k0, k1) = _correct(self.P, self.obs_var)
+        pos = self.x[0] + dt*self.x[1]
+        innovation = z - pos
+        self.x = np.stack((pos + k0*innovation, self.x[1] + k1*innovation))
+        return self.x[0].copy()
@@ -6,3 +6,60 @@ def MAD(proj):
 	#Gaussian K=1.4826
 	K=1.4826
 	return K*np.median(abs(np.subtract(proj,np.median(proj))))
+
+# Streaming version of MAD for matching: the distances of the matched
+# projections are added one at a time to a histogram with exponentially
+# decaying weights, so old fixes fade out (an effective window of 'window'
+# fixes) and memory is fixed by the number of bins. The median and the MAD
+# are read off the histogram, without re-scanning any history.
+WINDOW = 200		#Effective number of recent distances
+BIN_WIDTH = 0.25	#Meters
+MAX_VALUE = 100.0	#Larger distances are counted in the last bin
+MIN_COUNT = 20		#Distances needed before sigma() adapts
+MIN_SIGMA = 1.0		#Lower bound for sigma()
+
+class OnlineMAD(object):
+
+	def __init__(self, default, window=WINDOW, bin_width=BIN_WIDTH, max_value=MAX_VALUE):
+		#default: sigma returned until MIN_COUNT distances were seen
+		self.default = default
+		self.bin_width = bin_width
+		self.weights = np.zeros(int(np.ceil(max_value/bin_width)))
+		self.decay = 1.0 - 1.0/window
+		#New values get weight 'scale'; scale grows instead of decaying every bin
+		self.scale = 1.0
+		self.count = 0
+
+	def update(self, value):
+		i = min(int(abs(value)/self.bin_width), len(self.weights) - 1)
+		self.scale /= self.decay
+		self.weights[i] += self.scale
+		self.count += 1
+		if self.scale > 1e100:
+			self.weights /= self.scale
+			self.scale = 1.0
+
+	def _cdf(self):
+		#Bin edges and the cumulative weight at each edge; values are spread evenly within a bin
+		edges = np.arange(len(self.weights) + 1)*self.bin_width
+		return edges, np.concatenate(([0.0], np.cumsum(self.weights)))
+
+	def median(self):
+		edges, cdf = self._cdf()
+		return np.interp(cdf[-1]/2, cdf, edges)
+
+	def mad(self):
+		#d such that half of the weight lies within [median - d, median + d].
+		#The covered weight is piecewise linear in d with breakpoints at the
+		#distances of the bin edges from the median, so interpolating there is exact.
+		edges, cdf = self._cdf()
+		m = np.interp(cdf[-1]/2, cdf, edges)
+		d = np.unique(np.abs(edges - m))
+		covered = np.interp(m + d, edges, cdf) - np.interp(m - d, edges, cdf)
+		return np.interp(cdf[-1]/2, covered, d)
+
+	def sigma(self):
+		#Gaussian error estimate, like MAD()
+		if self.count < MIN_COUNT:
+			return self.default
+		return max(MIN_SIGMA, 1.4826*self.mad())
@@ -0,0 +1,117 @@
+# Matches whole directories of GPS traces in parallel.
+# Command line arguments: directory or glob of trace CSV files, see --help
+#
+# The road network around all traces is loaded once in the parent process and
+# saved as memory-mapped arrays (RoadIndex.save). Every worker process maps the
+# same files read-only, so the network exists once in memory no matter how many
+# workers run, and no worker opens SpatiaLite.
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from gps_reader import read_observations
+
+DEFAULT_OUTPUT_DIR = 'matched_files'
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+logger = logging.getLogger(__name__)
+
+def trace_paths(pattern):
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(glob.glob(pattern))
+
+def output_path(path, output_dir):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, name + '_matched.csv')
+
+# --- Worker side ---
+
+def _init_worker(index_dir):
+    import db_wrapper
+    # The matcher logs per fix; failures are reported by the parent
+    logging.disable(logging.WARNING)
+    from road_index import RoadIndex
+    db_wrapper.set_road_index(RoadIndex.load(index_dir, mmap=True))
+
+def _match_trace(path, output_dir, viterbi_kwargs):
+    from viterbi import viterbi
+    start = time.perf_counter()
+    observations = read_observations(path)
+    try:
+        viterbi(observations, filename=output_path(path, output_dir), **viterbi_kwargs)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return path, len(observations), time.perf_counter() - start, error
+
+# --- Parent side ---
+
+def build_index(paths, buffer, index_dir):
+    """Load the road network around all traces and save it to 'index_dir'."""
+    from road_index import RoadIndex
+    index = RoadIndex.from_corridors([read_observations(path) for path in paths], buffer)
+    index.save(index_dir)
+    return index
+
+def batch_match(paths, output_dir=DEFAULT_OUTPUT_DIR, workers=DEFAULT_WORKERS, index_dir=None, **viterbi_kwargs):
+    """
+    Match every trace in 'paths' on a pool of 'workers' processes, writing one
+    *_matched.csv per trace to 'output_dir'. If 'index_dir' holds a saved
+    RoadIndex it is used as is, else the network around the traces is fetched.
+    Returns a list of (path, fixes, seconds, error) tuples.
+    """
+    from viterbi import prefetch_buffer
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    buffer = prefetch_buffer(**viterbi_kwargs)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if index_dir is None or not os.path.exists(os.path.join(index_dir, 'meta.json')):
+            index_dir = index_dir or tmp_dir
+            logger.info(f"Building road index for {len(paths)} traces in {index_dir}...")
+            build_index(paths, buffer, index_dir)
+
+        results = []
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index_dir,)) as pool:
+            futures = [pool.submit(_match_trace, path, output_dir, viterbi_kwargs) for path in paths]
+            for future in as_completed(futures):
+                path, fixes, seconds, error = future.result()
+                results.append((path, fixes, seconds, error))
+                if error:
+                    logger.error(f"{path}: FAILED after {seconds:.2f}s ({error})")
+                else:
+                    logger.info(f"{path}: {fixes} fixes in {seconds:.2f}s ({fixes / max(seconds, 1e-9):.1f} fixes/s)")
+        elapsed = time.perf_counter() - start
+
+    total = sum(fixes for _, fixes, _, error in results if not error)
+    logger.info(f"Matched {total} fixes from {sum(1 for r in results if not r[3])}/{len(results)} traces "
+          f"in {elapsed:.2f}s ({total / max(elapsed, 1e-9):.1f} fixes/s with {workers} workers)")
+    return results
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Map match a directory of GPS traces in parallel.')
+    parser.add_argument('traces', help='directory of trace CSV files, or a glob')
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--index-dir', default=None,
+                        help='saved road index to use, or where to save the one built for this run')
+    parser.add_argument('--radius', type=float, default=None)
+    parser.add_argument('--n', type=int, default=None)
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    paths = trace_paths(args.traces)
+    if not paths:
+        raise Exception(f'No trace files found for {args.traces}')
+    viterbi_kwargs = {key: value for key, value in (('radius', args.radius), ('n', args.n)) if value is not None}
+    batch_match(paths, args.output_dir, args.workers, args.index_dir, **viterbi_kwargs)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,228 @@
+# Benchmarks the matcher stage by stage on the gps_data/ traces.
+# Command line arguments: see --help
+#
+# Every trace is matched against a generated road network around it (see
+# synthetic_roads.py), so no SpatiaLite database is needed and runs are
+# reproducible. Stages:
+#   query       db_wrapper.query_segments_within_radius, per fix
+#   emission    compute_emission_probabilities, per fix
+#   transition  compute_transition_probabilities, per pair of consecutive fixes
+#   dp          viterbi._viterbi_step, per DP step
+#   viterbi     viterbi.viterbi end to end, per trace
+# For each stage the latency percentiles of the calls and the peak traced
+# memory (tracemalloc, measured in a separate pass since tracing slows the
+# calls down) are reported.
+#
+# Results can be saved as a baseline JSON file; later runs are compared to it
+# and report the stages that got slower or bigger than the tolerance.
+# Latencies are only comparable on the machine that recorded the baseline, so
+# a regression is a warning; with --strict (e.g. a CI job that records its own
+# baseline) it exits with status 1.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import db_wrapper
+import synthetic_roads
+import viterbi
+from batch_match import trace_paths
+from emission_probability import compute_emission_probabilities
+from gps_reader import read_observations
+from road_graph import RoadGraph
+from transition_probability import compute_transition_probabilities
+
+STAGES = ('query', 'emission', 'transition', 'dp', 'viterbi')
+PERCENTILES = (50, 90, 99)
+DEFAULT_TRACES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gps_data')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+TOLERANCE = 0.25    # allowed relative slowdown / growth before a stage counts as regressed
+MIN_DELTA_MS = 0.05  # ignore slowdowns smaller than this, timer noise on tiny stages
+COMPARED = ('p50_ms', 'p90_ms', 'peak_kb')
+
+logger = logging.getLogger(__name__)
+
+def _timed(fn, args_list):
+    """Call fn(*args) for every args tuple. Returns the results and latencies in ms."""
+    results, latencies = [], []
+    for args in args_list:
+        start = time.perf_counter()
+        results.append(fn(*args))
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    return results, latencies
+
+def _peak_kb(fn, args_list):
+    """Peak memory traced while calling fn(*args) for every args tuple, in KB."""
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        for args in args_list:
+            fn(*args)
+        return (tracemalloc.get_traced_memory()[1] - base) / 1024.0
+    finally:
+        tracemalloc.stop()
+
+def _run_stage(stats, stage, fn, args_list, memory):
+    results, latencies = _timed(fn, args_list)
+    stats[stage]['latencies'].extend(latencies)
+    if memory:
+        stats[stage]['peak_kb'] = max(stats[stage]['peak_kb'], _peak_kb(fn, args_list))
+    return results
+
+def _dp_chain(emissions, transitions):
+    """
+    Arguments of every _viterbi_step call, chained like in viterbi().
+    transitions[t] are the log-transitions from emissions[t] to emissions[t+1].
+    """
+    steps = []
+    prev_log_probs = viterbi._to_log_probs(emissions[0][1]) if emissions else None
+    for (_, probabilities, _), log_transitions in zip(emissions[1:], transitions):
+        log_emissions = viterbi._to_log_probs(probabilities)
+        steps.append((prev_log_probs, log_transitions, log_emissions))
+        prev_log_probs, _ = viterbi._viterbi_step(prev_log_probs, log_transitions, log_emissions)
+    return steps
+
+def benchmark_trace(path, stats, radius, n, limit=None, routed=False, memory=True, **network_kwargs):
+    """Run all stages on one trace, adding the measurements to 'stats'. Returns the number of fixes."""
+    observations = read_observations(path)[:limit]
+    with synthetic_roads.synthetic_network_around(observations, **network_kwargs) as (index, ways):
+        graph = RoadGraph(index) if routed else None
+        _run_stage(stats, 'query', db_wrapper.query_segments_within_radius,
+                   [(o[0], o[1], radius) for o in observations], memory)
+        emissions = _run_stage(stats, 'emission', compute_emission_probabilities,
+                               [(o, radius, n) for o in observations], memory)
+
+        # Transitions between consecutive fixes that have candidates
+        matched = [e for e in emissions if e[0] is not None]
+        pairs = [(prev[2], cur[2], prev[0], cur[0], graph) for prev, cur in zip(matched, matched[1:])]
+        transitions = _run_stage(stats, 'transition', compute_transition_probabilities, pairs, memory)
+        log_transitions = [viterbi._to_log_probs(np.asarray(t, dtype=np.float64)) for t in transitions]
+        _run_stage(stats, 'dp', viterbi._viterbi_step, _dp_chain(matched, log_transitions), memory)
+
+        _run_stage(stats, 'viterbi', lambda obs: viterbi.viterbi(obs, radius=radius, n=n, routed=routed),
+                   [(observations,)], memory)
+    stats['network']['ways'] += len(ways)
+    stats['network']['segments'] += len(index.seg_start)
+    return len(observations)
+
+def summarize(stats):
+    summary = {}
+    for stage in STAGES:
+        latencies = np.array(stats[stage]['latencies'])
+        if len(latencies) == 0:
+            continue
+        entry = {'calls': int(len(latencies)), 'mean_ms': float(latencies.mean())}
+        for p in PERCENTILES:
+            entry[f'p{p}_ms'] = float(np.percentile(latencies, p))
+        entry['peak_kb'] = float(stats[stage]['peak_kb'])
+        summary[stage] = entry
+    return summary
+
+def compare(summary, baseline, tolerance=TOLERANCE):
+    """List of (stage, metric, baseline value, value) that regressed."""
+    regressions = []
+    for stage, entry in summary.items():
+        old = baseline.get('stages', {}).get(stage)
+        if old is None:
+            continue
+        for metric in COMPARED:
+            if metric not in old or not old[metric]:
+                continue
+            too_slow = entry[metric] > old[metric] * (1 + tolerance)
+            if metric.endswith('_ms'):
+                too_slow = too_slow and entry[metric] - old[metric] > MIN_DELTA_MS
+            if too_slow:
+                regressions.append((stage, metric, old[metric], entry[metric]))
+    return regressions
+
+def print_summary(summary, fixes, seconds):
+    header = f"{'stage':<12}{'calls':>8}{'mean ms':>10}" + ''.join(f"{'p%d ms' % p:>10}" for p in PERCENTILES) + f"{'peak KB':>10}"
+    print(header)
+    for stage, entry in summary.items():
+        print(f"{stage:<12}{entry['calls']:>8}{entry['mean_ms']:>10.3f}"
+              + ''.join(f"{entry[f'p{p}_ms']:>10.3f}" for p in PERCENTILES) + f"{entry['peak_kb']:>10.1f}")
+    print(f"{fixes} fixes in {seconds:.2f}s")
+
+def run(paths, radius=viterbi.RADIUS, n=viterbi.N, limit=None, routed=False, memory=True, **network_kwargs):
+    stats = {stage: {'latencies': [], 'peak_kb': 0.0} for stage in STAGES}
+    stats['network'] = {'ways': 0, 'segments': 0}
+    fixes = 0
+    start = time.perf_counter()
+    for path in paths:
+        logger.info(f"Benchmarking {path}...")
+        fixes += benchmark_trace(path, stats, radius, n, limit, routed, memory, **network_kwargs)
+    return {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                 'host': platform.node(), 'processor': platform.processor(),
+                 'traces': [os.path.basename(p) for p in paths], 'fixes': fixes, 'radius': radius, 'n': n,
+                 'limit': limit, 'routed': routed, 'network': dict(stats['network'], **network_kwargs)},
+        'stages': summarize(stats),
+        'seconds': time.perf_counter() - start,
+    }
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the map matcher on a synthetic road network.')
+    parser.add_argument('traces', nargs='?', default=DEFAULT_TRACES, help='directory of trace CSV files, or a glob')
+    parser.add_argument('--limit', type=int, default=None, help='fixes per trace')
+    parser.add_argument('--radius', type=float, default=viterbi.RADIUS)
+    parser.add_argument('--n', type=int, default=viterbi.N)
+    parser.add_argument('--routed', action='store_true', help='routed transitions (road_graph.py)')
+    parser.add_argument('--grid-spacing', type=float, default=synthetic_roads.GRID_SPACING)
+    parser.add_argument('--arterials-per-km', type=float, default=synthetic_roads.ARTERIALS_PER_KM)
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--strict', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--output', default=None, help='also write the results to this JSON file')
+    args = parser.parse_args(argv[1:])
+    # Progress of the benchmark only, not the per-fix messages of the matcher
+    logging.basicConfig(level=logging.ERROR, format='%(message)s')
+    logger.setLevel(logging.INFO)
+
+    paths = trace_paths(args.traces)
+    if not paths:
+        raise Exception(f'No trace files found for {args.traces}')
+    results = run(paths, args.radius, args.n, args.limit, args.routed, not args.no_memory,
+                  grid_spacing=args.grid_spacing, arterials_per_km=args.arterials_per_km)
+    print_summary(results['stages'], results['meta']['fixes'], results['seconds'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    changed = [key for key in ('fixes', 'radius', 'n', 'routed', 'network')
+               if baseline.get('meta', {}).get(key) != results['meta'][key]]
+    if changed:
+        print(f"Warning: the baseline was recorded with different {', '.join(changed)}")
+    # Older baselines only recorded some of these; compare the ones they have
+    hardware = [key for key in ('host', 'machine', 'processor')
+                if key in baseline.get('meta', {}) and baseline['meta'][key] != results['meta'][key]]
+    if hardware:
+        print(f"Warning: the baseline was recorded on another machine (different {', '.join(hardware)}); "
+              f"run with --save-baseline to record one here")
+    regressions = compare(results['stages'], baseline, args.tolerance)
+    for stage, metric, old, new in regressions:
+        print(f"{'REGRESSION' if args.strict else 'Warning: slower'} {stage} {metric}: {old:.3f} -> {new:.3f}")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions and args.strict else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
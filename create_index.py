@@ -11,7 +11,8 @@ GEOMETRY_TYPE = 'LINESTRING'
 
 # --- ACTION REQUIRED: Set the path to your SpatiaLite library ---
 # find / -name "mod_spatialite.dylib" 2>/dev/null
-SPATIALITE_PATH = '/opt/homebrew/lib/mod_spatialite.dylib' # <-- UPDATE THIS PATH IF NEEDED
+# The SPATIALITE_PATH environment variable overrides it.
+SPATIALITE_PATH = os.environ.get('SPATIALITE_PATH', '/opt/homebrew/lib/mod_spatialite.dylib') # <-- UPDATE THIS PATH IF NEEDED
 
 # --- SCRIPT LOGIC ---
 
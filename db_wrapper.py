@@ -1,10 +1,17 @@
+import logging
 import pyproj
-import re
-import utils
-import pandas as pd
-from shapely import wkt
-from sqlalchemy import create_engine, event
+import queue
+import sqlite3
+import threading
+import shapely
 import os
+from contextlib import contextmanager
+from urllib.request import pathname2url
+import numpy as np
+import metrics
+from road_index import mercator_to_lonlat
+from geometry_cache import WAY_CACHE, WayGeometry
+from segment_store import pack_way_segments, segments_in_box
 
 # --- NEW, MORE ROBUST PATHING & SPATIALITE SETUP ---
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -15,87 +22,330 @@ DB_FILE = os.path.join(script_dir, 'socal_roads.sqlite')
 # Common paths on macOS (using Homebrew):
 # - For Apple Silicon (M1/M2/M3): '/opt/homebrew/lib/mod_spatialite.dylib'
 # - For Intel Macs: '/usr/local/lib/mod_spatialite.dylib'
-SPATIALITE_PATH = '/opt/homebrew/lib/mod_spatialite.dylib' # <-- UPDATE THIS PATH IF NEEDED
+# - On Linux usually just 'mod_spatialite'
+# The SPATIALITE_PATH environment variable overrides it.
+SPATIALITE_PATH = os.environ.get('SPATIALITE_PATH', '/opt/homebrew/lib/mod_spatialite.dylib') # <-- UPDATE THIS PATH IF NEEDED
 
 LINE_TABLE = 'lines'
 SEARCH_RADIUS_METERS = 50
+BOX_BATCH = 100  # boxes per bulk R-tree query, ways per geometry query
+POOL_SIZE = 8  # connections, at most one per concurrently querying thread
+STATEMENT_CACHE = 128  # prepared statements kept per connection
 
-# This function loads the SpatiaLite extension. It's needed for ANY spatial query.
-def load_spatialite(dbapi_conn, connection_record):
-    dbapi_conn.enable_load_extension(True)
-    dbapi_conn.load_extension(SPATIALITE_PATH)
+logger = logging.getLogger(__name__)
+
+# This function loads the SpatiaLite extension. It's needed for ANY query on
+# the 'lines' table (AsBinary); the tables written by ingest_osm.py and the
+# node table are plain SQLite. Returns False if it can't be loaded, e.g.
+# because this Python's sqlite3 is built without extension loading.
+def load_spatialite(connection):
+    try:
+        connection.enable_load_extension(True)
+        connection.load_extension(SPATIALITE_PATH)
+        connection.enable_load_extension(False)
+        return True
+    except (AttributeError, sqlite3.OperationalError):
+        return False
+
+
+class ConnectionPool(object):
+    """
+    Up to 'size' read-only sqlite3 connections to 'db_file', opened on first
+    use, each set up by on_connect (by default load_spatialite). A connection
+    is used by one thread at a time, so the pool can be shared by threads.
+    Queries are parameterized with constant SQL text, so sqlite3 prepares
+    every statement once per connection and reuses it from its cache.
+    """
+
+    def __init__(self, db_file, size=POOL_SIZE, on_connect=load_spatialite):
+        self.db_file = db_file
+        self.size = size
+        self.on_connect = on_connect
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._warned = False
+
+    def _connect(self):
+        # mode=ro: fail on a missing file instead of creating an empty database
+        uri = f"file:{pathname2url(os.path.abspath(self.db_file))}?mode=ro"
+        connection = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE)
+        if self.on_connect is not None and self.on_connect(connection) is False and not self._warned:
+            self._warned = True
+            logger.warning(f"SpatiaLite not loaded from {SPATIALITE_PATH}, set SPATIALITE_PATH; "
+                           f"only databases from ingest_osm.py can be queried")
+        return connection
+
+    @contextmanager
+    def connection(self):
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_open = self._opened < self.size
+                self._opened += can_open
+            if not can_open:
+                connection = self._idle.get()
+            else:
+                try:
+                    connection = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+        try:
+            yield connection
+        finally:
+            self._idle.put(connection)
+
+    def execute(self, sql, params=()):
+        """All rows of one parameterized query, as a list of tuples."""
+        with self.connection() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self._opened = 0
+
+# In-memory road index (see road_index.py). When set, radius queries are
+# answered from memory instead of SpatiaLite.
+_road_index = None
+# Whether the database has the per-segment tables written by ingest_osm.py,
+# looked up on the first segment query
+_has_segment_tables = None
 
 wgs84_to_mercator = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
 
-try:
-    engine = create_engine(f'sqlite:///{DB_FILE}')
-    # We MUST listen for the connect event here too, so that every time
-    # a query is made, the spatial functions are available.
-    event.listen(engine, 'connect', load_spatialite)
-    print(f"Successfully configured database connection for: {DB_FILE}")
-except Exception as e:
-    print(f"Unable to connect to database file {DB_FILE}")
-    print(f"Error: {e}")
-    raise
+# Connections are only opened by the first query
+pool = ConnectionPool(DB_FILE)
+
+def set_road_index(index):
+    """
+    Answer query_ways_within_radius from 'index' (a road_index.RoadIndex) instead
+    of the database. Pass None to go back to SpatiaLite. Returns the previous index.
+    """
+    global _road_index
+    previous = _road_index
+    _road_index = index
+    return previous
+
+def get_road_index():
+    return _road_index
+
+def load_road_index(cell_size=None):
+    """Load the whole 'lines' table into memory once and use it for all queries."""
+    from road_index import RoadIndex, DEFAULT_CELL_SIZE
+    index = RoadIndex.from_database(pool, cell_size or DEFAULT_CELL_SIZE)
+    set_road_index(index)
+    return index
 
 def query_ways_within_radius(lat, lon, radius=SEARCH_RADIUS_METERS):
     """
     Query the SpatiaLite database for ways (roads) that are within 'radius' meters
     from the point defined by 'lat' and 'lon'.
     """
+    with metrics.timer('lookup'):
+        return _query_ways_within_radius(lat, lon, radius)
+
+def _query_ways_within_radius(lat, lon, radius):
+    if _road_index is not None:
+        return _road_index.query_ways_within_radius(lat, lon, radius)
+
     merc_x, merc_y = wgs84_to_mercator.transform(lon, lat)
     min_x, max_x = merc_x - radius, merc_x + radius
     min_y, max_y = merc_y - radius, merc_y + radius
     
+    ways = _query_ways(*_rtree_box_query(min_x, min_y, max_x, max_y))
+    if not ways:
+        return None, None
+
+    point_in_merc = (merc_x, merc_y)
+    return point_in_merc, ways
+
+def query_segments_within_radius(lat, lon, radius=SEARCH_RADIUS_METERS):
+    """
+    Only the road segments whose bounding boxes intersect the search box around
+    'lat', 'lon', packed into arrays (see segment_store.pack_way_segments).
+    Returns the point in EPSG:3857 and the packed segments, or (None, None).
+    A long way passing near the point contributes only its nearby segments,
+    whether they come from the road index, the per-segment R-tree of a
+    database built by ingest_osm.py, or the ways of the 'lines' table.
+    """
+    with metrics.timer('lookup'):
+        if _road_index is not None:
+            return _road_index.query_segments_within_radius(lat, lon, radius)
+        merc_x, merc_y = wgs84_to_mercator.transform(lon, lat)
+        if _segment_tables_exist():
+            packed = _query_segments(merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        else:
+            _, ways = _query_ways_within_radius(lat, lon, radius)
+            packed = segments_in_box(pack_way_segments(ways) if ways else None,
+                                     merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        if packed is None:
+            return None, None
+        return (merc_x, merc_y), packed
+
+def query_nearest_segments(lat, lon, k, radius=SEARCH_RADIUS_METERS, max_distance=None):
+    """
+    Segments around 'lat', 'lon' in the first of the search boxes 'radius',
+    2 * 'radius', 4 * 'radius', ... (never beyond 'max_distance') that holds
+    at least k of them. A RoadIndex finds that box in one pass (see
+    RoadIndex.query_nearest_segments); the database and a TileCache are
+    queried box by box.
+    """
+    max_distance = max(radius, max_distance if max_distance is not None else radius)
+    if _road_index is not None and hasattr(_road_index, 'query_nearest_segments'):
+        with metrics.timer('lookup'):
+            return _road_index.query_nearest_segments(lat, lon, k, radius, max_distance)
+    while True:
+        point, packed = query_segments_within_radius(lat, lon, radius)
+        if (packed is not None and len(packed['way_ids']) >= k) or radius >= max_distance:
+            return point, packed
+        metrics.count('expanded')
+        radius = min(2 * radius, max_distance)
+
+def _segment_tables_exist():
+    global _has_segment_tables
+    if _has_segment_tables is None:
+        from ingest_osm import SEGMENT_RTREE
+        rows = pool.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (SEGMENT_RTREE,))
+        _has_segment_tables = bool(rows[0][0])
+    return _has_segment_tables
+
+def _query_segments(min_x, min_y, max_x, max_y):
+    from ingest_osm import SEGMENT_TABLE, SEGMENT_RTREE
     qstring = f"""
-        SELECT
-            osm_id,
-            oneway,
-            AsText(geometry) as wkt_geometry
-        FROM {LINE_TABLE}
-        WHERE ROWID IN (
-            SELECT id
-            FROM rtree_{LINE_TABLE}_geometry
-            WHERE minX <= {max_x} AND maxX >= {min_x} AND
-                  minY <= {max_y} AND maxY >= {min_y}
-        )
+        SELECT s.way_osm_id, s.idx, s.x0, s.y0, s.x1, s.y1, s.heading, s.oneway
+        FROM {SEGMENT_RTREE} r JOIN {SEGMENT_TABLE} s ON s.id = r.id
+        WHERE r.min_x <= :max_x AND r.max_x >= :min_x AND
+              r.min_y <= :max_y AND r.max_y >= :min_y AND
+              -- the R-tree stores float32 boxes, rounded outwards
+              MIN(s.x0, s.x1) <= :max_x AND MAX(s.x0, s.x1) >= :min_x AND
+              MIN(s.y0, s.y1) <= :max_y AND MAX(s.y0, s.y1) >= :min_y
     """
-    df = pd.read_sql_query(qstring, engine)
+    rows = pool.execute(qstring, {'min_x': min_x, 'min_y': min_y, 'max_x': max_x, 'max_y': max_y})
+    if not rows:
+        return None
+    rows = np.array(rows, dtype=np.float64)
+    return {'endpoints': rows[:, 2:6].reshape(-1, 2, 2),
+            'angles': rows[:, 6],
+            'way_ids': rows[:, 0].astype(np.int64),
+            'index_in_way': rows[:, 1].astype(np.int64),
+            'oneway': rows[:, 7] != 0}
 
-    if df.empty:
-        return None, None
+def query_ways_in_boxes(boxes):
+    """
+    Bulk version of query_ways_within_radius: all ways whose bounding box
+    intersects any of the (min_x, min_y, max_x, max_y) EPSG:3857 boxes, each
+    way returned once. Boxes are sent BOX_BATCH at a time as one UNION query.
+    """
+    ways = {}
+    for i in range(0, len(boxes), BOX_BATCH):
+        queries = [_rtree_box_query(*box) for box in boxes[i:i + BOX_BATCH]]
+        subqueries = ' UNION '.join(sql for sql, _ in queries)
+        for way in _query_ways(subqueries, [p for _, params in queries for p in params]):
+            ways[way['osm_id']] = way
+    return list(ways.values())
 
-    point_in_merc = (merc_x, merc_y)
+# The geometry (and so the R-tree) is stored in EPSG:4326, so the EPSG:3857
+# search box is converted back to degrees before filtering. Returns the SQL
+# and its parameters.
+def _rtree_box_query(min_x, min_y, max_x, max_y):
+    (min_lon, max_lon), (min_lat, max_lat) = mercator_to_lonlat([min_x, max_x], [min_y, max_y])
+    return (f"""SELECT id
+            FROM rtree_{LINE_TABLE}_geometry
+            WHERE minX <= ? AND maxX >= ? AND minY <= ? AND maxY >= ?""",
+            [float(max_lon), float(min_lon), float(max_lat), float(min_lat)])
+
+def _is_oneway(value):
+    return str(value).lower() in ['yes', '1', 'true']
+
+def _query_ways(rowid_query, params):
+    """
+    Ways with a ROWID returned by 'rowid_query'. Only the ids are read first;
+    geometry is fetched and parsed only for ways missing from WAY_CACHE, by
+    ROWID ('osm_id' is not indexed).
+    """
+    qstring = f"""
+        SELECT ROWID, osm_id, oneway
+        FROM {LINE_TABLE}
+        WHERE ROWID IN ({rowid_query})
+    """
+    rows, rowids = {}, {}
+    for rowid, osm_id, oneway in pool.execute(qstring, params):
+        osm_id = int(osm_id)
+        if osm_id >= 0:
+            rows[osm_id] = _is_oneway(oneway)
+            rowids.setdefault(osm_id, rowid)
+    geometries = {osm_id: WAY_CACHE.get(osm_id) for osm_id in rows}
+    geometries.update(_load_geometries([rowids[osm_id] for osm_id, geometry in geometries.items()
+                                        if geometry is None]))
     ways = []
-    for _, row in df.iterrows():
-        osm_id = int(row['osm_id'])
-        if osm_id < 0:
+    for osm_id, oneway in rows.items():
+        geometry = geometries.get(osm_id)
+        if geometry is None:
             continue
-        oneway = True if str(row['oneway']).lower() in ['yes', '1', 'true'] else False
-        line = wkt.loads(row['wkt_geometry'])
-        projected_coords = [wgs84_to_mercator.transform(px, py) for px, py in line.coords]
-        way = {'osm_id': osm_id, 'points': projected_coords, 'oneway': oneway}
+        way = {'osm_id': osm_id, 'points': geometry.point_tuples(), 'oneway': oneway, 'geometry': geometry}
         ways.append(way)
-    return point_in_merc, ways
+    return ways
+
+def decode_wkb_lines(blobs):
+    """
+    Decode WKB geometries in bulk (shapely.from_wkb). Returns one (P, 2)
+    coordinate array per blob, empty for NULL or empty geometries.
+    """
+    geometries = shapely.from_wkb(list(blobs))
+    coords, owners = shapely.get_coordinates(geometries, return_index=True)
+    return np.split(coords, np.searchsorted(owners, np.arange(1, len(geometries))))
+
+# Selects the geometry of BOX_BATCH rows by ROWID; shorter lists are padded
+# by repeating their last ROWID, so the statement text never changes
+_GEOMETRY_QUERY = f"""
+    SELECT osm_id, oneway, AsBinary(geometry)
+    FROM {LINE_TABLE}
+    WHERE ROWID IN ({', '.join('?' * BOX_BATCH)})
+"""
+
+def _load_geometries(rowids):
+    """
+    Fetch, decode and project the geometry of the ways stored at the given
+    ROWIDs of the lines table and add them to WAY_CACHE. Returns {osm_id: WayGeometry}.
+    """
+    loaded = {}
+    for i in range(0, len(rowids), BOX_BATCH):
+        batch = [int(rowid) for rowid in rowids[i:i + BOX_BATCH]]
+        rows = pool.execute(_GEOMETRY_QUERY, batch + batch[-1:] * (BOX_BATCH - len(batch)))
+        for (osm_id, oneway, _), lonlat in zip(rows, decode_wkb_lines(row[2] for row in rows)):
+            osm_id = int(osm_id)
+            if osm_id in loaded or len(lonlat) == 0:
+                continue
+            loaded[osm_id] = WAY_CACHE.put(WayGeometry(osm_id, _is_oneway(oneway), lonlat=lonlat))
+    return loaded
 
 def get_node_id(way_id, index):
-    """DEPRECATED: This function is not compatible with the new data structure."""
-    print("WARNING: get_node_id is deprecated and is not functional.")
-    return None
+    """
+    Gets the OSM node id of a specific node in a way from the node table
+    (see node_table.py), or None if it is unknown.
+    """
+    import node_table
+    table = node_table.table_for_path([{'way_osm_id': way_id}], DB_FILE)
+    node_ids, _ = table.lookup([int(way_id)], [index])
+    return int(node_ids[0]) if node_ids[0] >= 0 else None
 
 def get_node_gps_point(way_id, index):
     """
     Gets the original lat/lon coordinates for a specific node in a way.
     """
-    qstring = f"""
-        SELECT AsText(geometry) as wkt_geometry
-        FROM {LINE_TABLE}
-        WHERE osm_id = '{way_id}'
-    """
-    df = pd.read_sql_query(qstring, engine)
-    if df.empty:
+    way_id = int(way_id)
+    geometry = WAY_CACHE.get(way_id)
+    if geometry is None:
+        # a single lookup by osm_id, which scans the lines table
+        rowids = [row[0] for row in pool.execute(f"SELECT ROWID FROM {LINE_TABLE} WHERE osm_id = ?", (way_id,))]
+        geometry = _load_geometries(rowids).get(way_id)
+    if geometry is None:
         return (None, None)
-    line = wkt.loads(df.iloc[0]['wkt_geometry'])
-    points = list(line.coords)
-    return points[index] if len(points) > index else (None, None)
-
+    return tuple(geometry.lonlat[index].tolist()) if len(geometry.lonlat) > index else (None, None)
@@ -0,0 +1,131 @@
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+from road_index import EARTH_RADIUS
+
+# SUMMARY
+#--------------------
+# Opt-in cache of emission candidates for corridors that are driven again and
+# again (Home2SF / SF2Home, ...). A fix is keyed by
+#   (x, y quantized to QUANTUM meters, course bucket of HEADING_BUCKET
+#    degrees, radius, n, max_distance and k of the nearest segment search)
+# and an entry keeps the top-n candidate segments found for the first fix
+# with that key, packed like segment_store.pack_way_segments (endpoints,
+# angles, way_ids, index_in_way, oneway), or None if there were none.
+#
+# On a hit compute_emission_probabilities skips the road network query and
+# the scoring of all segments in the radius: only the distances, tangent and
+# distance scores of the n cached candidates are recomputed for the exact
+# position, course and sigma of the fix, and re-ranked. So the scores are
+# exact; what the quantization can change is which n segments compete, for
+# fixes at the edge of a cell or a course bucket.
+#
+# Entries are evicted least recently used beyond 'max_entries'. save() and
+# load() persist the cache as a .npz file, so a warm cache carries over
+# between runs. The cache knows nothing about the road network: clear it (or
+# use another file) when the database changes.
+#
+# Usage:
+#   cache = EmissionCache(path='emission_cache.npz')  # loads the file if it exists
+#   viterbi(observations, emission_cache=cache)
+#   cache.save()
+
+QUANTUM = 1.0          # meters
+HEADING_BUCKET = 30.0  # degrees
+DEFAULT_MAX_ENTRIES = 200000
+PACKED_FIELDS = ('endpoints', 'angles', 'way_ids', 'index_in_way', 'oneway')
+
+def mercator_point(lat, lon):
+    """road_index.lonlat_to_mercator for one point, without the NumPy overhead."""
+    return (EARTH_RADIUS * math.radians(lon),
+            EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+
+
+class EmissionCache(object):
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, path=None, quantum=QUANTUM, heading_bucket=HEADING_BUCKET):
+        self.max_entries = max_entries
+        self.path = path
+        self.quantum = quantum
+        self.heading_bucket = heading_bucket
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    # 'point' in EPSG:3857, 'course' in degrees
+    def key(self, point, course, radius, n, max_distance=None, k=1):
+        # SensorLog reports a negative course when it is unknown
+        bucket = int(course // self.heading_bucket) if math.isfinite(course) and course >= 0 else -1
+        reach = max(radius, max_distance) if max_distance is not None else radius
+        return (int(round(point[0] / self.quantum)), int(round(point[1] / self.quantum)), bucket, radius, n, reach, k)
+
+    def get(self, key):
+        """(True, packed candidates or None) on a hit, (False, None) on a miss."""
+        if key not in self._entries:
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, self._entries[key]
+
+    def put(self, key, packed):
+        self._entries[key] = packed
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'max_entries': self.max_entries,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    # All entries in one .npz: the keys, and the candidates of all entries
+    # concatenated, entry i owning rows offsets[i]:offsets[i+1]. Entries
+    # without candidates have no rows.
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            raise Exception('No path to save the emission cache to')
+        keys = np.array([k[:3] for k in self._entries], dtype=np.int64).reshape(-1, 3)
+        radii = np.array([k[3] for k in self._entries], dtype=np.float64)
+        ns = np.array([k[4] for k in self._entries], dtype=np.int64)
+        reaches = np.array([k[5] for k in self._entries], dtype=np.float64)
+        ks = np.array([k[6] for k in self._entries], dtype=np.int64)
+        entries = [e for e in self._entries.values() if e is not None]
+        counts = [0 if e is None else len(e['way_ids']) for e in self._entries.values()]
+        arrays = {}
+        for field in PACKED_FIELDS:
+            if entries:
+                arrays[field] = np.concatenate([e[field] for e in entries])
+            else:
+                arrays[field] = np.zeros((0, 2, 2) if field == 'endpoints' else 0)
+        with open(path, 'wb') as f:
+            np.savez(f, keys=keys, radii=radii, ns=ns, reaches=reaches, ks=ks,
+                     offsets=np.concatenate(([0], np.cumsum(counts))), **arrays)
+
+    def load(self, path):
+        """Add the entries saved in 'path', oldest first, as if they had just been put."""
+        with np.load(path) as data:
+            arrays = {field: data[field] for field in PACKED_FIELDS}
+            offsets = data['offsets']
+            radii = data['radii'].tolist()
+            # files written before the nearest segment search only had radius queries
+            reaches = data['reaches'].tolist() if 'reaches' in data else radii
+            ks = data['ks'].tolist() if 'ks' in data else [1] * len(radii)
+            for i, (key, radius, n, reach, k) in enumerate(zip(data['keys'].tolist(), radii, data['ns'].tolist(),
+                                                               reaches, ks)):
+                start, end = offsets[i], offsets[i + 1]
+                packed = {field: arrays[field][start:end] for field in PACKED_FIELDS} if end > start else None
+                self.put(tuple(key) + (radius, n, reach, k), packed)
@@ -1,12 +1,18 @@
+import logging
 import numpy as np
 import math
-from db_wrapper import query_ways_within_radius
+import metrics
+from db_wrapper import query_segments_within_radius, query_nearest_segments
 import utils
+from segment_store import CandidateSet
+from emission_cache import PACKED_FIELDS, mercator_point
 # --- MODIFIED: Import weights from our new config file ---
 from model_weights import EMISSION_WEIGHTS
 
 GPS_SIGMA = 6.7
 
+logger = logging.getLogger(__name__)
+
 # W_DIST = 0.8
 # W_TANG = 0.2
 
@@ -15,7 +21,13 @@ GPS_SIGMA = 6.7
 # The main datastructure in this file is the ways array, which contains all the
 # OSM ways within a certain distance of the observation. A way in the ways array
 # is a dict: ways[0] = {'osm_id': 264056469L, 'points': [(x1,y1), (x2,y2) ... ]
-# With each function, the ways dictionary is extended with different attributes.
+# With each _add_* function, the ways dictionary is extended with different attributes.
+#
+# compute_emission_probabilities gets the segments near the observation as
+# packed arrays (db_wrapper.query_segments_within_radius, see
+# segment_store.pack_way_segments for the layout) and scores all of them at
+# once with the array versions of the _add_* functions; the per-way functions
+# are kept for simple_match.
 
 
 # A segment is the line between two consecutive nodes
@@ -93,39 +105,78 @@ def _add_emission_probabilities(ways):
         ]
     return ways
 
-# Return n segments with highest emission probabilities
-def _get_top_n(ways, n):
-    segments = []
-    probabilities = []
-    for way in ways:
-        for i, p in enumerate(way['emission_probabilities']):
-            segments.append({'way_osm_id': way['osm_id'], 'index_in_way': i, 'endpoints': way['segments'][i],'direction': None, 'distance_score':way['distance_scores'][i], 'tangent_score':way['tangent_scores'][i], 'distance':way['distances'][i]})
-            probabilities.append(p)
-    combined = zip(segments, probabilities)
-    combined.sort(key=lambda el: -el[1])
-    segments = [x[0] for x in combined]
-    probabilities = [x[1] for x in combined]
-    return segments[:n], probabilities[:n]
+# Array versions of _add_tangent_scores and _add_distance_scores
+def _tangent_scores(angles, oneway, base_angle):
+    diff_angle = np.where(oneway, angles - base_angle, np.mod(angles, math.pi) - base_angle % math.pi)
+    return (np.cos(diff_angle) + 1) / 2
+
+def _distance_scores(distances, sigma):
+    # Rayleigh
+    return (distances / sigma**2) * np.exp(-(distances**2) / (2 * (sigma**2)))
+
+# Indices of the n highest probabilities, by descending probability. Uses a
+# partial selection, only the n winners are sorted; ties keep their original order.
+def _top_n_indices(probabilities, n):
+    if len(probabilities) > n:
+        top = np.argpartition(-probabilities, n - 1)[:n]
+    else:
+        top = np.arange(len(probabilities))
+    return top[np.lexsort((top, -probabilities[top]))]
+
+# Return n segments with highest emission probabilities, as a CandidateSet
+# and an array of probabilities, and the indices of the n segments in 'packed'.
+def _get_top_n(packed, distances, distance_scores, tangent_scores, probabilities, n):
+    top = _top_n_indices(probabilities, n)
+    segments = CandidateSet(packed['way_ids'][top], packed['index_in_way'][top], packed['endpoints'][top],
+                            distances[top], distance_scores[top], tangent_scores[top])
+    return segments, probabilities[top], top
+
+def _score_segments(packed, point, course, n, sigma):
+    with metrics.timer('emission'):
+        w_dist = EMISSION_WEIGHTS['distance']
+        w_orientation = EMISSION_WEIGHTS['orientation']
+        distances = utils.point_to_linesegs_dist(packed['endpoints'], point)
+        tangent_scores = _tangent_scores(packed['angles'], packed['oneway'], course)
+        distance_scores = _distance_scores(distances, sigma)
+        probabilities = distance_scores * w_dist + tangent_scores * w_orientation
+        return _get_top_n(packed, distances, distance_scores, tangent_scores, probabilities, n)
 
 # Observation provided in form: (lat, lon, course) all in degrees
 # Radius in meters
 # n is the number of segments returned with the top emission probabilities
-def compute_emission_probabilities(observation, radius, n):
-    lat, lon, course, speed = observation
-    course = math.radians(-course + 90)
-    point, ways = query_ways_within_radius(lat, lon, radius)
-    
+# sigma is the GPS error of the Rayleigh distance score, e.g. from MAD.OnlineMAD
+# cache is an optional emission_cache.EmissionCache: on a hit only the cached
+# candidates are scored, without querying the road network
+# With max_distance, fixes with fewer than k segments within radius are searched
+# in doubled boxes up to max_distance (db_wrapper.query_nearest_segments)
+def compute_emission_probabilities(observation, radius, n, sigma=GPS_SIGMA, cache=None, max_distance=None, k=1):
+    lat, lon, course_degrees, speed = observation
+    course = math.radians(-course_degrees + 90)
+    if cache is not None:
+        point = mercator_point(lat, lon)
+        key = cache.key(point, course_degrees, radius, n, max_distance, k)
+        hit, packed = cache.get(key)
+        if hit:
+            metrics.count('emission_cache_hits')
+            if packed is None:
+                return None, None, None
+            segments, probabilities, _ = _score_segments(packed, point, course, n, sigma)
+            return segments, probabilities, point
+        metrics.count('emission_cache_misses')
+
+    if max_distance is None:
+        point, packed = query_segments_within_radius(lat, lon, radius)
+    else:
+        point, packed = query_nearest_segments(lat, lon, k, radius, max_distance)
+
     # --- NEW DIAGNOSTIC CHECK ---
-    if not ways:
-        print(f"  --> DEBUG: No road segments found near Lat: {lat}, Lon: {lon}")
+    if packed is None:
+        logger.debug(f"No road segments found near Lat: {lat}, Lon: {lon}")
+        if cache is not None:
+            cache.put(key, None)
         return None, None, None
-        
-    ways = _add_segments(ways)
-    ways = _add_distances(ways, point)
-    ways = _add_tangents(ways)
-    ways = _add_tangent_scores(ways, course)
-    ways = _add_distance_scores(ways, GPS_SIGMA)
-    ways = _add_emission_probabilities(ways)
-    segments, probabilities = _get_top_n(ways, n)
-    return segments, probabilities, point
 
+    segments, probabilities, top = _score_segments(packed, point, course, n, sigma)
+    if cache is not None:
+        cache.put(key, {field: packed[field][top] for field in PACKED_FIELDS})
+    return segments, probabilities, point
@@ -0,0 +1,112 @@
+import math
+from collections import OrderedDict
+import numpy as np
+from road_index import lonlat_to_mercator, mercator_to_lonlat
+
+# SUMMARY
+#--------------------
+# Bounded LRU cache of parsed and projected way geometry, keyed by OSM way id.
+# Consecutive fixes mostly hit the same ways, so the WKT of a way is parsed
+# and projected once, together with its per-segment arrays, and then reused
+# by db_wrapper (queries, node coordinates), emission_probability (segments
+# and angles) and utils (node coordinates of the matched path).
+#
+# The cache is bounded by the total size of the cached arrays in bytes.
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Rough per-entry overhead of the Python objects besides the arrays
+ENTRY_OVERHEAD = 512
+
+# Angle of the tangent of each segment, the line between its two endpoints.
+# endpoints has shape (K,2,2).
+def segment_angles(endpoints):
+    delta = endpoints[:, 1] - endpoints[:, 0]
+    vertical = np.where(delta[:, 1] > 0, math.pi/2, -math.pi/2)
+    return np.where(delta[:, 0] == 0, vertical, np.arctan2(delta[:, 1], delta[:, 0]))
+
+
+class WayGeometry(object):
+    """
+    Geometry of one way: its vertices in EPSG:4326 (lonlat) and EPSG:3857
+    (points), and the derived segments (K,2,2) and segment angles (K,).
+    """
+    __slots__ = ('osm_id', 'oneway', 'lonlat', 'points', 'segments', 'angles')
+
+    def __init__(self, osm_id, oneway, lonlat=None, points=None):
+        self.osm_id = osm_id
+        self.oneway = oneway
+        if points is None:
+            lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)
+            points = np.column_stack(lonlat_to_mercator(lonlat[:, 0], lonlat[:, 1]))
+        elif lonlat is None:
+            points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+            lonlat = np.column_stack(mercator_to_lonlat(points[:, 0], points[:, 1]))
+        self.lonlat = lonlat
+        self.points = points
+        self.segments = np.stack((points[:-1], points[1:]), axis=1)
+        self.angles = segment_angles(self.segments)
+
+    @property
+    def nbytes(self):
+        return (self.lonlat.nbytes + self.points.nbytes + self.segments.nbytes +
+                self.angles.nbytes + ENTRY_OVERHEAD)
+
+    # 'points' in the format of db_wrapper.query_ways_within_radius
+    def point_tuples(self):
+        return [tuple(p) for p in self.points.tolist()]
+
+
+class GeometryCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, osm_id):
+        geometry = self._entries.get(osm_id)
+        if geometry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(osm_id)
+        self.hits += 1
+        return geometry
+
+    def put(self, geometry):
+        previous = self._entries.pop(geometry.osm_id, None)
+        if previous is not None:
+            self.bytes -= previous.nbytes
+        self._entries[geometry.osm_id] = geometry
+        self.bytes += geometry.nbytes
+        # Evict least recently used entries, but always keep the newest one
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            self.evictions += 1
+        return geometry
+
+    def __contains__(self, osm_id):
+        return osm_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+
+# Shared by db_wrapper, emission_probability and utils
+WAY_CACHE = GeometryCache()
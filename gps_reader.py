@@ -0,0 +1,76 @@
+import numpy as np
+
+# SUMMARY
+#--------------------
+# Columnar reader for SensorLog GPS logs. Unlike plot_gps_data.read_gps_file,
+# only the requested columns are kept and they are converted straight into
+# typed NumPy arrays. Files can be read whole or streamed chunk by chunk, so
+# multi-hour logs don't have to fit in memory.
+#
+# Both the ';' delimited SensorLog files and the ',' exports in gps_data/ are
+# supported; the delimiter is detected from the header line.
+
+DEFAULT_COLUMNS = ('lat', 'long', 'course', 'speed', 'timestamp')
+OBSERVATION_COLUMNS = ('lat', 'long', 'course', 'speed')
+CHUNKSIZE = 10000  # rows per chunk
+
+# Columns that are not plain floats
+COLUMN_TYPES = {
+    'time': 'datetime64[ms]',
+    'locTimeStamp': np.float64,
+    'timestamp': np.int64,
+}
+
+def _sniff_delimiter(header):
+    return ';' if header.count(';') > header.count(',') else ','
+
+def _to_array(values, column):
+    dtype = COLUMN_TYPES.get(column, np.float64)
+    if dtype == np.float64:
+        values = [v if v else 'nan' for v in values]
+    return np.array(values, dtype=dtype)
+
+def iter_gps_chunks(f, columns=DEFAULT_COLUMNS, chunksize=CHUNKSIZE, delimiter=None):
+    """
+    Yield the requested columns of an open GPS log, 'chunksize' rows at a
+    time, as dicts {'column_name': array}.
+    """
+    header = f.readline()
+    delimiter = delimiter or _sniff_delimiter(header)
+    headers = [h.strip() for h in header.split(delimiter)]
+    missing = [c for c in columns if c not in headers]
+    if missing:
+        raise Exception(f'Columns not in file: {missing}')
+    indices = [headers.index(c) for c in columns]
+    data = [[] for _ in columns]
+    for line in f:
+        if not line.strip():
+            continue
+        fields = line.split(delimiter)
+        for values, i in zip(data, indices):
+            values.append(fields[i].strip())
+        if len(data[0]) >= chunksize:
+            yield {c: _to_array(values, c) for c, values in zip(columns, data)}
+            data = [[] for _ in columns]
+    if data[0]:
+        yield {c: _to_array(values, c) for c, values in zip(columns, data)}
+
+def read_gps_columns(path, columns=DEFAULT_COLUMNS, delimiter=None):
+    """Read the requested columns of a whole GPS log into typed arrays."""
+    with open(path, 'r') as f:
+        chunks = list(iter_gps_chunks(f, columns, CHUNKSIZE, delimiter))
+    if not chunks:
+        return {c: _to_array([], c) for c in columns}
+    return {c: np.concatenate([chunk[c] for chunk in chunks]) for c in columns}
+
+def iter_observations(path, chunksize=CHUNKSIZE, delimiter=None):
+    """Stream a GPS log as viterbi observations (lat, lon, course, speed)."""
+    with open(path, 'r') as f:
+        for chunk in iter_gps_chunks(f, OBSERVATION_COLUMNS, chunksize, delimiter):
+            for observation in zip(*(chunk[c].tolist() for c in OBSERVATION_COLUMNS)):
+                yield observation
+
+def read_observations(path, delimiter=None):
+    """All observations of a GPS log as a list of (lat, lon, course, speed)."""
+    data = read_gps_columns(path, OBSERVATION_COLUMNS, delimiter)
+    return list(zip(*(data[c].tolist() for c in OBSERVATION_COLUMNS)))
@@ -0,0 +1,249 @@
+# Builds the road database straight from a local OSM highway extract.
+# Command line arguments: path to .osm or .osm.pbf file, optional path to database
+#
+# Replaces the osmconvert / osmfilter / osm2pgsql / create_index.py steps of the
+# README. The extract is streamed (xml.etree iterparse for .osm, pyosmium for
+# .osm.pbf), nodes and way node lists are staged in temporary SQLite tables so
+# memory use doesn't grow with the extract, and then every highway is written
+# out already prepared for matching:
+#   road_ways       (osm_id, oneway, highway)            one row per way
+#   segments        (id, way_osm_id, idx, x0, y0, x1, y1, heading, length, oneway)
+#                   one row per segment, coordinates in EPSG:3857, heading in
+#                   radians as in geometry_cache.segment_angles, length in meters
+#   rtree_segments  (id, min_x, max_x, min_y, max_y)    R-tree on the segment boxes
+#   way_nodes       node table, see node_table.py
+# Oneway flags are normalized to 0/1: 'yes'/'true'/'1', roundabouts and
+# motorways are oneway, and ways tagged oneway=-1 are stored reversed, so a
+# oneway segment is always driven from (x0, y0) to (x1, y1). Ways with nodes
+# missing from the extract get no segments.
+#
+# Only plain SQLite is needed (the R-tree module is built in); the file can be
+# opened with SpatiaLite as well. Load it with RoadIndex.from_ingested.
+
+import logging
+import os
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+import numpy as np
+
+import node_table
+from geometry_cache import segment_angles
+from road_index import lonlat_to_mercator
+
+WAY_TABLE = 'road_ways'
+SEGMENT_TABLE = 'segments'
+SEGMENT_RTREE = 'rtree_segments'
+BATCH_SIZE = 100000  # rows per executemany / per fetch
+ONEWAY_VALUES = ('yes', 'true', '1')
+REVERSED_VALUES = ('-1', 'reverse')
+IMPLIED_ONEWAY = {('highway', 'motorway'), ('junction', 'roundabout')}
+
+logger = logging.getLogger(__name__)
+
+def normalize_oneway(tags):
+    """1 if the way is oneway, -1 if it is oneway against its node order, else 0."""
+    value = str(tags.get('oneway', '')).strip().lower()
+    if value in ONEWAY_VALUES:
+        return 1
+    if value in REVERSED_VALUES:
+        return -1
+    if value in ('no', 'false', '0'):
+        return 0
+    return 1 if any(item in IMPLIED_ONEWAY for item in tags.items()) else 0
+
+
+class _Writer(object):
+    """Batches parsed nodes and highways into the staging tables."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.nodes, self.refs, self.ways = [], [], []
+        self.n_ways = 0
+
+    def add_node(self, node_id, lon, lat):
+        self.nodes.append((node_id, lon, lat))
+        if len(self.nodes) >= BATCH_SIZE:
+            self.flush_nodes()
+
+    def add_way(self, way_id, tags, refs):
+        if 'highway' not in tags:
+            return
+        oneway = normalize_oneway(tags)
+        if oneway == -1:
+            refs = refs[::-1]
+        self.ways.append((way_id, int(oneway != 0), tags['highway']))
+        self.refs.extend((way_id, i, ref) for i, ref in enumerate(refs))
+        self.n_ways += 1
+        if len(self.refs) >= BATCH_SIZE:
+            self.flush_ways()
+
+    def flush_nodes(self):
+        self.connection.executemany("INSERT OR REPLACE INTO osm_nodes VALUES (?, ?, ?)", self.nodes)
+        self.nodes = []
+
+    def flush_ways(self):
+        self.connection.executemany(f"INSERT OR REPLACE INTO {WAY_TABLE} VALUES (?, ?, ?)", self.ways)
+        self.connection.executemany("INSERT INTO way_refs VALUES (?, ?, ?)", self.refs)
+        self.ways, self.refs = [], []
+
+    def flush(self):
+        self.flush_nodes()
+        self.flush_ways()
+
+def _parse_xml(path, writer):
+    root = None
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            root = root if root is not None else element
+            continue
+        if element.tag == 'node':
+            writer.add_node(int(element.get('id')), float(element.get('lon')), float(element.get('lat')))
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            writer.add_way(int(element.get('id')), tags, [int(nd.get('ref')) for nd in element.iter('nd')])
+        else:
+            continue
+        # Drop parsed elements, including the root's references to them
+        element.clear()
+        root.clear()
+
+def _parse_pbf(path, writer):
+    try:
+        import osmium
+    except ImportError:
+        raise Exception('Reading .osm.pbf files needs pyosmium (pip install osmium), or convert to .osm first')
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            writer.add_node(n.id, n.location.lon, n.location.lat)
+
+        def way(self, w):
+            writer.add_way(w.id, {tag.k: tag.v for tag in w.tags}, [nd.ref for nd in w.nodes])
+
+    Handler().apply_file(path, locations=False)
+
+def _create_tables(connection):
+    node_table.create_node_tables(connection)
+    connection.execute(f"DROP TABLE IF EXISTS {WAY_TABLE}")
+    connection.execute(f"DROP TABLE IF EXISTS {SEGMENT_TABLE}")
+    connection.execute(f"DROP TABLE IF EXISTS {SEGMENT_RTREE}")
+    connection.execute(f"""
+        CREATE TABLE {WAY_TABLE} (
+            osm_id INTEGER PRIMARY KEY,
+            oneway INTEGER NOT NULL,
+            highway TEXT
+        )""")
+    connection.execute(f"""
+        CREATE TABLE {SEGMENT_TABLE} (
+            id INTEGER PRIMARY KEY,
+            way_osm_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            x0 REAL NOT NULL, y0 REAL NOT NULL,
+            x1 REAL NOT NULL, y1 REAL NOT NULL,
+            heading REAL NOT NULL,
+            length REAL NOT NULL,
+            oneway INTEGER NOT NULL
+        )""")
+    connection.execute(f"CREATE VIRTUAL TABLE {SEGMENT_RTREE} USING rtree(id, min_x, max_x, min_y, max_y)")
+
+# Rows (way_osm_id, idx, node_id, lon, lat, oneway) of all highways, ordered
+# by way and index, in chunks that never split a way.
+def _iter_way_chunks(connection):
+    cursor = connection.execute(f"""
+        SELECT r.way_osm_id, r.idx, r.node_id, n.lon, n.lat, w.oneway
+        FROM way_refs r
+        JOIN {WAY_TABLE} w ON w.osm_id = r.way_osm_id
+        LEFT JOIN osm_nodes n ON n.id = r.node_id
+        ORDER BY r.way_osm_id, r.idx""")
+    carry = np.empty((0, 6))
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        rows = np.concatenate((carry, np.array(rows, dtype=np.float64)))
+        last_way = rows[-1, 0]
+        split = np.searchsorted(rows[:, 0], last_way)
+        carry = rows[split:]
+        if split > 0:
+            yield rows[:split]
+    if len(carry):
+        yield carry
+
+def _write_segments(connection, rows, first_id):
+    """
+    Write the node rows of all ways in 'rows' and the segments of the ways
+    with all their nodes. Returns the number of segments and of incomplete ways.
+    """
+    way_ids = rows[:, 0].astype(np.int64)
+    node_ids = rows[:, 2].astype(np.int64)
+    connection.executemany(f"INSERT OR REPLACE INTO {node_table.NODE_TABLE} VALUES (?, ?, ?, ?, ?)",
+                           zip(way_ids.tolist(), rows[:, 1].astype(np.int64).tolist(), node_ids.tolist(),
+                               *(np.where(np.isnan(c), None, c).tolist() for c in (rows[:, 3], rows[:, 4]))))
+    # Ways with a node that isn't in the extract get no segments
+    incomplete = np.unique(way_ids[np.isnan(rows[:, 3]) | np.isnan(rows[:, 4])])
+    rows = rows[~np.isin(way_ids, incomplete)]
+    way_ids = rows[:, 0].astype(np.int64)
+    x, y = lonlat_to_mercator(rows[:, 3], rows[:, 4])
+    starts = np.nonzero(way_ids[:-1] == way_ids[1:])[0]
+    endpoints = np.stack((np.column_stack((x[starts], y[starts])), np.column_stack((x[starts + 1], y[starts + 1]))), axis=1)
+    headings = segment_angles(endpoints)
+    lengths = np.hypot(*(endpoints[:, 1] - endpoints[:, 0]).T)
+    ids = np.arange(first_id, first_id + len(starts))
+    x0, y0, x1, y1 = endpoints[:, 0, 0], endpoints[:, 0, 1], endpoints[:, 1, 0], endpoints[:, 1, 1]
+    connection.executemany(f"INSERT INTO {SEGMENT_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                           zip(ids.tolist(), way_ids[starts].tolist(), rows[starts, 1].astype(np.int64).tolist(),
+                               x0.tolist(), y0.tolist(), x1.tolist(), y1.tolist(), headings.tolist(),
+                               lengths.tolist(), rows[starts, 5].astype(np.int64).tolist()))
+    connection.executemany(f"INSERT INTO {SEGMENT_RTREE} VALUES (?, ?, ?, ?, ?)",
+                           zip(ids.tolist(), np.minimum(x0, x1).tolist(), np.maximum(x0, x1).tolist(),
+                               np.minimum(y0, y1).tolist(), np.maximum(y0, y1).tolist()))
+    return len(starts), len(incomplete)
+
+def ingest(osm_path, db_file):
+    """
+    Stream the highways of 'osm_path' into 'db_file'. Existing road_ways,
+    segments, rtree_segments and way_nodes tables are replaced; everything
+    is written in one transaction.
+    """
+    connection = sqlite3.connect(db_file)
+    try:
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.execute("PRAGMA temp_store = FILE")
+        _create_tables(connection)
+        writer = _Writer(connection)
+        if osm_path.endswith('.pbf'):
+            _parse_pbf(osm_path, writer)
+        else:
+            _parse_xml(osm_path, writer)
+        writer.flush()
+        logger.info(f"Parsed {writer.n_ways} highways, building segments...")
+
+        connection.execute("CREATE INDEX way_refs_way ON way_refs (way_osm_id, idx)")
+        n_segments, n_incomplete = 0, 0
+        for rows in _iter_way_chunks(connection):
+            segments, incomplete = _write_segments(connection, rows, n_segments + 1)
+            n_segments += segments
+            n_incomplete += incomplete
+        connection.execute(f"CREATE INDEX {SEGMENT_TABLE}_way ON {SEGMENT_TABLE} (way_osm_id, idx)")
+        connection.commit()
+    finally:
+        connection.close()
+    if n_incomplete:
+        logger.warning(f"Skipped {n_incomplete} ways with nodes missing from the extract")
+    logger.info(f"Stored {n_segments} segments of {writer.n_ways - n_incomplete} ways in {db_file}")
+    return n_segments
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        raise Exception('args: path to .osm or .osm.pbf file, [path to database]')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if len(argv) == 3:
+        db_file = argv[2]
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        db_file = os.path.join(script_dir, 'socal_roads.sqlite')
+    ingest(argv[1], db_file)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,128 @@
+# Replays the gps_data/ traces against a running match_server.py.
+# Command line arguments: see --help
+#
+# Every simulated vehicle opens its own connection and sends the fixes of one
+# trace (the traces are dealt out round robin) one request per fix, on the
+# schedule of the recording sped up --speedup times: the traces are logged at
+# about one fix per --interval seconds. Vehicles start spread over one
+# interval. A vehicle waits for the answer to a fix before sending the next
+# one, so when the server falls behind, fixes go out later than scheduled.
+#
+# Reports the fixes per second that were offered and achieved, the response
+# latency percentiles, and the fraction of fixes sent more than one
+# (sped up) interval late. The server keeps up with the offered load when
+# almost no fix is late; raise --vehicles or --speedup until it doesn't to
+# find how many vehicles one server sustains.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import numpy as np
+
+from batch_match import trace_paths
+from gps_reader import read_observations
+from match_server import DEFAULT_HOST, DEFAULT_PORT
+
+DEFAULT_TRACES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gps_data')
+FIX_INTERVAL = 1.0  # seconds between fixes in the recordings
+LATE_FRACTION = 0.01  # the load counts as sustained if at most this many fixes are late
+PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger(__name__)
+
+async def _vehicle(vehicle, observations, host, port, start, interval, stats):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i, fix in enumerate(observations):
+            scheduled = start + i * interval
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent = time.monotonic()
+            if sent - scheduled > interval:
+                stats['late'] += 1
+            writer.write(json.dumps({'vehicle': vehicle, 'fix': list(fix)}).encode() + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            stats['latencies'].append(time.monotonic() - sent)
+            if 'error' in response:
+                stats['errors'] += 1
+            stats['matched'] += len(response.get('matched', ()))
+        writer.write(json.dumps({'vehicle': vehicle, 'end': True}).encode() + b'\n')
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        stats['matched'] += len(response.get('matched', ()))
+    finally:
+        writer.close()
+
+async def _server_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(b'{"stats": true}\n')
+        await writer.drain()
+        return json.loads(await reader.readline())['stats']
+    finally:
+        writer.close()
+
+async def run(paths, vehicles, speedup, host=DEFAULT_HOST, port=DEFAULT_PORT, interval=FIX_INTERVAL, limit=None):
+    """Replay 'vehicles' vehicles against the server. Returns a summary dict."""
+    traces = [read_observations(path)[:limit] for path in paths]
+    interval = interval / speedup
+    stats = {'latencies': [], 'late': 0, 'errors': 0, 'matched': 0}
+    before = await _server_stats(host, port)
+    start = time.monotonic() + 0.1
+    await asyncio.gather(*(
+        _vehicle(f'{os.path.basename(paths[i % len(paths)])}-{i}', traces[i % len(traces)], host, port,
+                 start + interval * i / vehicles, interval, stats)
+        for i in range(vehicles)))
+    seconds = time.monotonic() - start
+    after = await _server_stats(host, port)
+
+    fixes = len(stats['latencies'])
+    latencies = np.array(stats['latencies']) * 1000.0
+    offered = sum(len(traces[i % len(traces)]) for i in range(vehicles))
+    duration = max(len(traces[i % len(traces)]) for i in range(vehicles)) * interval
+    summary = {
+        'vehicles': vehicles, 'speedup': speedup, 'fixes': fixes, 'seconds': seconds,
+        'offered_fixes_per_s': offered / max(duration, 1e-9),
+        'achieved_fixes_per_s': fixes / max(seconds, 1e-9),
+        'late_fraction': stats['late'] / max(fixes, 1),
+        'errors': stats['errors'], 'matched': stats['matched'],
+        'server_match_seconds': after['match_seconds'] - before['match_seconds'],
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = float(np.percentile(latencies, p)) if fixes else 0.0
+    summary['sustained'] = summary['late_fraction'] <= LATE_FRACTION and not stats['errors']
+    return summary
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Replay GPS traces against match_server.py.')
+    parser.add_argument('traces', nargs='?', default=DEFAULT_TRACES, help='directory of trace CSV files, or a glob')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--vehicles', type=int, default=10)
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay N times faster than real time')
+    parser.add_argument('--interval', type=float, default=FIX_INTERVAL, help='seconds between recorded fixes')
+    parser.add_argument('--limit', type=int, default=None, help='fixes per vehicle')
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    paths = trace_paths(args.traces)
+    if not paths:
+        raise Exception(f'No trace files found for {args.traces}')
+    summary = asyncio.run(run(paths, args.vehicles, args.speedup, args.host, args.port, args.interval, args.limit))
+    logger.info(f"{summary['vehicles']} vehicles at {summary['speedup']:g}x: {summary['fixes']} fixes in "
+                f"{summary['seconds']:.1f}s, {summary['achieved_fixes_per_s']:.1f} of "
+                f"{summary['offered_fixes_per_s']:.1f} fixes/s offered")
+    logger.info(f"latency p50 {summary['p50_ms']:.1f} ms, p90 {summary['p90_ms']:.1f} ms, "
+                f"p99 {summary['p99_ms']:.1f} ms; {100.0 * summary['late_fraction']:.1f}% of fixes late, "
+                f"{summary['errors']} errors; server busy matching {summary['server_match_seconds']:.1f}s")
+    logger.info('sustained' if summary['sustained'] else 'NOT sustained')
+    return 0 if summary['sustained'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,337 @@
+# Map matching service for live vehicles.
+# Command line arguments: see --help
+#
+# Line-delimited JSON over TCP. Every request line is answered by one
+# response line:
+#   {"vehicle": "bus-7", "fixes": [[lat, lon, course, speed], ...], "id": 12}
+#     -> {"vehicle": "bus-7", "id": 12, "matched": [segment, ...]}
+#   {"vehicle": "bus-7", "end": true}    decide the rest of the trip, close the session
+#     -> {"vehicle": "bus-7", "matched": [...], "closed": true}
+#   {"stats": true}
+#     -> {"stats": {...}}
+# "fix": [lat, lon, course, speed] can be sent instead of a one element
+# "fixes"; "id" is optional and echoed back. A segment is
+#   {"observation_index", "way_osm_id", "index_in_way", "direction", "distance", "endpoints"}
+# with the index of the fix in the vehicle's session and the endpoints in
+# EPSG:3857. Segments are sent as soon as they are decided (see
+# online_viterbi.py), so a response may carry segments of earlier fixes, or
+# none. Errors are answered with {"error": "..."}.
+#
+# Every vehicle id gets its own OnlineViterbi session. Sessions idle for
+# longer than --idle-timeout seconds are flushed and dropped; their last
+# segments are sent with "evicted": true if the connection is still open.
+#
+# The matching itself runs in one matcher thread, off the event loop, so
+# the loop keeps reading and writing while fixes are matched. Sessions and
+# the caches they share (way geometry, routes, emission candidates) are not
+# thread-safe, so there is exactly one such thread: to use more cores, run
+# one server per core and shard vehicles across them.
+#
+# Backpressure: at most --max-pending requests are in flight (queued for the
+# matcher, or answered but not yet written) over all connections. When that
+# many are in flight, connections stop reading, and TCP pushes the
+# backpressure to the clients. Responses wait for the client to read them
+# (StreamWriter.drain), so a client that stops reading stalls the rest.
+#
+# See load_generator.py to replay gps_data/ against a running server.
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import db_wrapper
+from online_viterbi import OnlineViterbi
+from viterbi import RADIUS, N, WINDOW
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+IDLE_TIMEOUT = 300.0  # seconds without fixes before a session is evicted
+MAX_PENDING = 256     # requests queued for the matcher thread
+MAX_SESSIONS = 10000
+MAX_LINE = 1 << 20    # bytes per request line
+CLOSE_TIMEOUT = 5.0   # seconds close() waits for connections to finish their requests
+MATCH_FIELDS = ('observation_index', 'way_osm_id', 'index_in_way', 'direction', 'distance', 'endpoints')
+
+logger = logging.getLogger(__name__)
+
+
+class _Session(object):
+    __slots__ = ('viterbi', 'lock', 'last_seen', 'connection')
+
+    def __init__(self, viterbi, connection):
+        self.viterbi = viterbi
+        self.lock = asyncio.Lock()  # keeps the fixes of one vehicle in order
+        self.last_seen = time.monotonic()
+        self.connection = connection  # the latest connection the vehicle sent on
+
+
+class _Connection(object):
+    __slots__ = ('writer', 'lock')
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = asyncio.Lock()
+
+    async def send(self, message):
+        async with self.lock:
+            if self.writer.is_closing():
+                return
+            self.writer.write(json.dumps(message).encode() + b'\n')
+            await self.writer.drain()
+
+
+def _matched(segments):
+    return [{field: segment[field] for field in MATCH_FIELDS} for segment in segments]
+
+def _push_all(viterbi, fixes):
+    decided = []
+    for fix in fixes:
+        decided.extend(viterbi.push(fix))
+    return _matched(decided)
+
+def _parse_fixes(request):
+    fixes = request['fixes'] if 'fixes' in request else [request['fix']]
+    fixes = [tuple(float(value) for value in fix) for fix in fixes]
+    if any(len(fix) != 4 for fix in fixes):
+        raise ValueError('a fix is [lat, lon, course, speed]')
+    return fixes
+
+
+class MatchServer(object):
+
+    # 'session_kwargs' are passed to every OnlineViterbi (graph, smooth,
+    # adaptive_sigma, emission_cache, ...)
+    def __init__(self, radius=RADIUS, n=N, lag=WINDOW, idle_timeout=IDLE_TIMEOUT, max_pending=MAX_PENDING,
+                 max_sessions=MAX_SESSIONS, **session_kwargs):
+        self.radius = radius
+        self.n = n
+        self.lag = lag
+        self.idle_timeout = idle_timeout
+        self.max_pending = max_pending
+        self.max_sessions = max_sessions
+        self.session_kwargs = session_kwargs
+        self.sessions = {}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='matcher')
+        self.counters = {'requests': 0, 'fixes': 0, 'matched': 0, 'errors': 0, 'evicted': 0, 'closed': 0}
+        self.match_seconds = 0.0
+        self._pending = None
+        self._server = None
+        self._evictor = None
+        self._handlers = {}  # connection task -> its StreamWriter
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self._server = await asyncio.start_server(self._handle, host, port, limit=MAX_LINE)
+        self._evictor = asyncio.create_task(self._evict_idle())
+        logger.info(f"Matching on {', '.join(str(s.getsockname()) for s in self._server.sockets)}")
+        return self._server
+
+    async def serve_forever(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop accepting, close the open connections and wait for their handlers."""
+        if self._evictor is not None:
+            self._evictor.cancel()
+            await asyncio.gather(self._evictor, return_exceptions=True)
+            self._evictor = None
+        if self._server is not None:
+            self._server.close()
+        # A closed connection ends its handler's read loop; the handler still
+        # waits for the requests it has queued
+        handlers = list(self._handlers)
+        for writer in self._handlers.values():
+            writer.close()
+        if handlers:
+            _, stalled = await asyncio.wait(handlers, timeout=CLOSE_TIMEOUT)
+            # Clients that stopped reading would keep their handlers waiting on drain
+            for task in stalled:
+                self._handlers[task].transport.abort()
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+            self._server = None
+        self.executor.shutdown(wait=True)
+
+    def stats(self):
+        return dict(self.counters, sessions=len(self.sessions), match_seconds=self.match_seconds)
+
+    async def _run(self, fn, *args):
+        """Run fn in the matcher thread; match_seconds adds up the time spent matching."""
+        def timed():
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.match_seconds += time.perf_counter() - start
+        return await asyncio.get_running_loop().run_in_executor(self.executor, timed)
+
+    async def _handle(self, reader, writer):
+        connection = _Connection(writer)
+        tasks = set()
+        handler = asyncio.current_task()
+        self._handlers[handler] = writer
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    await connection.send({'error': f'request longer than {MAX_LINE} bytes'})
+                    break
+                except ConnectionError:
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                # Stop reading while the matcher is saturated
+                await self._pending.acquire()
+                task = asyncio.create_task(self._respond(line, connection))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._handlers.pop(handler, None)
+            writer.close()
+
+    # The permit is held until the response is written, so a client that
+    # stops reading holds up at most max_pending responses
+    async def _respond(self, line, connection):
+        try:
+            try:
+                response = await self._request(line, connection)
+            except Exception as e:
+                self.counters['errors'] += 1
+                response = {'error': f'{type(e).__name__}: {e}'}
+            try:
+                await connection.send(response)
+            except ConnectionError:
+                pass
+        finally:
+            self._pending.release()
+
+    async def _request(self, line, connection):
+        request = json.loads(line)
+        self.counters['requests'] += 1
+        if request.get('stats'):
+            return {'stats': self.stats()}
+        vehicle = str(request['vehicle'])
+        response = {'vehicle': vehicle}
+        if 'id' in request:
+            response['id'] = request['id']
+
+        if request.get('end'):
+            session = self.sessions.pop(vehicle, None)
+            matched = []
+            if session is not None:
+                async with session.lock:
+                    matched = _matched(await self._run(session.viterbi.flush))
+                self.counters['closed'] += 1
+            self.counters['matched'] += len(matched)
+            response.update(matched=matched, closed=True)
+            return response
+
+        fixes = _parse_fixes(request)
+        session = self.sessions.get(vehicle)
+        if session is None:
+            if len(self.sessions) >= self.max_sessions:
+                raise Exception(f'too many sessions ({self.max_sessions})')
+            session = _Session(OnlineViterbi(self.radius, self.n, self.lag, **self.session_kwargs), connection)
+            self.sessions[vehicle] = session
+        session.last_seen = time.monotonic()
+        session.connection = connection
+        async with session.lock:
+            matched = await self._run(_push_all, session.viterbi, fixes)
+        self.counters['fixes'] += len(fixes)
+        self.counters['matched'] += len(matched)
+        response['matched'] = matched
+        return response
+
+    async def _evict_idle(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 0.05))
+            now = time.monotonic()
+            idle = [v for v, s in self.sessions.items() if now - s.last_seen > self.idle_timeout]
+            for vehicle in idle:
+                session = self.sessions.get(vehicle)
+                if session is None:
+                    continue
+                async with session.lock:
+                    # A request may have refreshed or ended the session while
+                    # this waited for the lock
+                    if (self.sessions.get(vehicle) is not session or
+                            time.monotonic() - session.last_seen <= self.idle_timeout):
+                        continue
+                    del self.sessions[vehicle]
+                    matched = _matched(await self._run(session.viterbi.flush))
+                self.counters['evicted'] += 1
+                self.counters['matched'] += len(matched)
+                logger.debug(f"Evicted idle session {vehicle}")
+                try:
+                    await session.connection.send({'vehicle': vehicle, 'matched': matched, 'evicted': True})
+                except ConnectionError:
+                    pass
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Serve online map matching over line-delimited JSON.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--tiles', default=None, help='road tiles written by tile_cache.py')
+    parser.add_argument('--index-dir', default=None, help='road index saved with RoadIndex.save')
+    parser.add_argument('--radius', type=float, default=RADIUS)
+    parser.add_argument('--n', type=int, default=N)
+    parser.add_argument('--lag', type=int, default=WINDOW)
+    parser.add_argument('--routed', action='store_true', help='routed transitions, needs --index-dir')
+    parser.add_argument('--smooth', action='store_true', help='Kalman filter the fixes (AKF.py)')
+    parser.add_argument('--adaptive-sigma', action='store_true', help='estimate the GPS error per vehicle (MAD.py)')
+    parser.add_argument('--emission-cache', default=None, help='.npz file of the emission cache, saved on exit')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT)
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING)
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS)
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # The matcher logs per fix
+    logging.getLogger('viterbi').setLevel(logging.ERROR)
+
+    session_kwargs = {'smooth': args.smooth, 'adaptive_sigma': args.adaptive_sigma}
+    if args.tiles:
+        from tile_cache import TileCache
+        db_wrapper.set_road_index(TileCache.load(args.tiles))
+    elif args.index_dir:
+        from road_index import RoadIndex
+        db_wrapper.set_road_index(RoadIndex.load(args.index_dir))
+    if args.routed:
+        from road_graph import RoadGraph
+        if not args.index_dir or args.tiles:
+            raise Exception('--routed needs --index-dir')
+        session_kwargs['graph'] = RoadGraph(db_wrapper.get_road_index())
+    if args.emission_cache:
+        from emission_cache import EmissionCache
+        session_kwargs['emission_cache'] = EmissionCache(path=args.emission_cache)
+
+    server = MatchServer(args.radius, args.n, args.lag, args.idle_timeout, args.max_pending,
+                         args.max_sessions, **session_kwargs)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.emission_cache:
+            session_kwargs['emission_cache'].save()
+        logger.info(f"Served {server.stats()}")
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,167 @@
+import time
+from contextlib import contextmanager
+
+# SUMMARY
+#--------------------
+# Pluggable metrics sink for the matching pipeline. The pipeline reports to
+# the installed sink through the module functions:
+#   with metrics.timer('emission'): ...    time spent in a stage
+#   metrics.count('skipped')               event counters
+#   metrics.observe('candidates', k)       value distributions (count/sum/min/max)
+# By default the NullSink is installed, and every call is a method call that
+# returns immediately (timer returns one shared no-op context manager), so
+# instrumentation costs next to nothing when nobody is listening.
+#
+# Stages timed by the pipeline: lookup (road network query), emission
+# (scoring, excluding the lookup), transition, dp, backtrack.
+# Counters: observations, expanded (search box doubled past the radius; once
+# per fix with a road index, once per doubling without), skipped (no
+# candidates within max_distance), route_cache_hits / route_cache_misses,
+# emission_cache_hits / emission_cache_misses.
+# Observed: candidates (per observation).
+#
+# Usage:
+#   with metrics.recording() as sink:
+#       viterbi(observations)
+#   print(sink.report())
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullSink(object):
+    """Discards everything."""
+    enabled = False
+
+    def timer(self, stage):
+        return _NULL_TIMER
+
+    def count(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+
+class _Timer(object):
+    __slots__ = ('sink', 'stage', 'start')
+
+    def __init__(self, sink, stage):
+        self.sink = sink
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.sink.add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class RecordingSink(object):
+    """
+    Keeps totals in memory: seconds and calls per stage, counters, and
+    count/sum/min/max of observed values. report() also includes the hit
+    rate of the way geometry cache since the sink was created.
+    """
+    enabled = True
+
+    def __init__(self):
+        from geometry_cache import WAY_CACHE
+        self.times = {}     # stage -> [seconds, calls]
+        self.counters = {}
+        self.values = {}    # name -> [count, sum, min, max]
+        self._cache = WAY_CACHE
+        self._cache_start = (WAY_CACHE.hits, WAY_CACHE.misses)
+
+    def timer(self, stage):
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        entry = self.times.get(stage)
+        if entry is None:
+            self.times[stage] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        entry = self.values.get(name)
+        if entry is None:
+            self.values[name] = [1, value, value, value]
+        else:
+            entry[0] += 1
+            entry[1] += value
+            entry[2] = min(entry[2], value)
+            entry[3] = max(entry[3], value)
+
+    def cache_hit_rates(self):
+        rates = {}
+        hits = self._cache.hits - self._cache_start[0]
+        misses = self._cache.misses - self._cache_start[1]
+        if hits + misses:
+            rates['way_geometry'] = hits / (hits + misses)
+        for name in ('route', 'emission'):
+            hits = self.counters.get(f'{name}_cache_hits', 0)
+            misses = self.counters.get(f'{name}_cache_misses', 0)
+            if hits + misses:
+                rates[name] = hits / (hits + misses)
+        return rates
+
+    def report(self):
+        return {
+            'stages': {stage: {'seconds': seconds, 'calls': calls, 'mean_ms': 1000.0 * seconds / calls}
+                       for stage, (seconds, calls) in self.times.items()},
+            'counters': dict(self.counters),
+            'values': {name: {'count': c, 'mean': total / c, 'min': lo, 'max': hi}
+                       for name, (c, total, lo, hi) in self.values.items()},
+            'cache_hit_rates': self.cache_hit_rates(),
+        }
+
+
+_sink = NullSink()
+
+def set_sink(sink):
+    """Install 'sink' (None for the NullSink). Returns the previous sink."""
+    global _sink
+    previous = _sink
+    _sink = sink if sink is not None else NullSink()
+    return previous
+
+def get_sink():
+    return _sink
+
+def timer(stage):
+    return _sink.timer(stage)
+
+def count(name, value=1):
+    _sink.count(name, value)
+
+def observe(name, value):
+    _sink.observe(name, value)
+
+# Install 'sink' for the duration of the block
+@contextmanager
+def using(sink):
+    previous = set_sink(sink)
+    try:
+        yield sink
+    finally:
+        set_sink(previous)
+
+def recording():
+    """Record into a new RecordingSink for the duration of the block."""
+    return using(RecordingSink())
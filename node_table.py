@@ -0,0 +1,214 @@
+# Node table: maps (way_osm_id, index_in_way) to the OSM node id and the
+# lon/lat of that node.
+# Command line arguments: path to .osm file, optional path to database
+#
+# The 'lines' table only stores way geometry, so the node ids of a matched
+# segment can't be recovered from it. This script reads the highway extract
+# (california_roads.osm from the README) once and stores every way's node
+# list in a 'way_nodes' table next to 'lines'. Matched paths are then turned
+# into (start node, end node) pairs with one vectorized lookup.
+
+import logging
+import os
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+from urllib.request import pathname2url
+import numpy as np
+
+NODE_TABLE = 'way_nodes'
+BATCH_SIZE = 50000  # rows per executemany
+ID_BATCH = 500      # way ids bound per IN (...) query
+INDEX_BITS = 16     # OSM ways have at most 2000 nodes
+
+logger = logging.getLogger(__name__)
+
+def connect(db_file, mode='ro'):
+    """
+    sqlite3 connection to an existing database, read-only by default ('rw'
+    to write). Fails on a missing file instead of creating an empty database.
+    """
+    return sqlite3.connect(f"file:{pathname2url(os.path.abspath(db_file))}?mode={mode}", uri=True)
+
+def _keys(way_ids, indices):
+    return (np.asarray(way_ids, dtype=np.int64) << INDEX_BITS) + np.asarray(indices, dtype=np.int64)
+
+
+class NodeTable(object):
+    """Sorted arrays of (way, index) keys with their node ids and lon/lat."""
+
+    def __init__(self, way_ids, indices, node_ids, lonlat):
+        keys = _keys(way_ids, indices)
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)[order]
+        self.lonlat = np.asarray(lonlat, dtype=np.float64).reshape(-1, 2)[order]
+
+    # Load the node table, or only the rows of the given ways
+    @classmethod
+    def from_database(cls, db_file, way_ids=None):
+        connection = connect(db_file)
+        try:
+            qstring = f"SELECT way_osm_id, idx, node_id, lon, lat FROM {NODE_TABLE}"
+            if way_ids is None:
+                rows = connection.execute(qstring).fetchall()
+            else:
+                way_ids = [int(w) for w in way_ids]
+                rows = []
+                for i in range(0, len(way_ids), ID_BATCH):
+                    batch = way_ids[i:i + ID_BATCH]
+                    rows += connection.execute(f"{qstring} WHERE way_osm_id IN ({', '.join('?' * len(batch))})",
+                                               batch).fetchall()
+            rows = np.array(rows, dtype=np.float64).reshape(-1, 5)
+        finally:
+            connection.close()
+        return cls(rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3:5])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, way_ids, indices):
+        """Node ids (-1 if unknown) and lon/lat (nan if unknown) of the given nodes."""
+        keys = _keys(way_ids, indices)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64), np.full((len(keys), 2), np.nan)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        node_ids = np.where(found, self.node_ids[pos], -1)
+        lonlat = np.where(found[:, None], self.lonlat[pos], np.nan)
+        return node_ids, lonlat
+
+    def resolve_path(self, path):
+        """
+        (start node id, end node id) of every segment on a Viterbi path, as
+        strings, in the direction the segment was traversed. None for
+        unmatched elements or unknown nodes.
+        """
+        node_ids = []
+        for segment, start, end in zip(path, *self._lookup_path(path)[:2]):
+            if segment.get('way_osm_id') is None or start < 0 or end < 0:
+                node_ids.append(None)
+            elif segment.get('direction') == -1:
+                node_ids.append((str(end), str(start)))
+            else:
+                node_ids.append((str(start), str(end)))
+        return node_ids
+
+    def resolve_path_gps(self, path):
+        """Same as resolve_path, but with the (lon, lat) of the nodes."""
+        node_gps = []
+        for segment, start, end in zip(path, *self._lookup_path(path)[2:]):
+            if segment.get('way_osm_id') is None:
+                node_gps.append(None)
+            elif segment.get('direction') == -1:
+                node_gps.append((tuple(end), tuple(start)))
+            else:
+                node_gps.append((tuple(start), tuple(end)))
+        return node_gps
+
+    # Start and end node ids and lon/lat of every path element
+    def _lookup_path(self, path):
+        way_ids = [s['way_osm_id'] if s.get('way_osm_id') is not None else 0 for s in path]
+        indices = np.array([s.get('index_in_way') or 0 for s in path], dtype=np.int64)
+        start_ids, start_lonlat = self.lookup(way_ids, indices)
+        end_ids, end_lonlat = self.lookup(way_ids, indices + 1)
+        return start_ids.tolist(), end_ids.tolist(), start_lonlat.tolist(), end_lonlat.tolist()
+
+
+_node_table = None
+
+def set_node_table(table):
+    global _node_table
+    previous = _node_table
+    _node_table = table
+    return previous
+
+def get_node_table():
+    return _node_table
+
+def table_for_path(path, db_file=None):
+    """The loaded node table, or the rows of the ways on 'path' read in one query."""
+    if _node_table is not None:
+        return _node_table
+    if db_file is None:
+        import db_wrapper
+        db_file = db_wrapper.DB_FILE
+    way_ids = {s['way_osm_id'] for s in path if s.get('way_osm_id') is not None}
+    return NodeTable.from_database(db_file, way_ids)
+
+# --- Building the table ---
+
+# The node table plus the temporary staging tables for the parsed nodes and
+# way node lists; also used by ingest_osm.py
+def create_node_tables(connection):
+    connection.execute(f"DROP TABLE IF EXISTS {NODE_TABLE}")
+    connection.execute(f"""
+        CREATE TABLE {NODE_TABLE} (
+            way_osm_id INTEGER NOT NULL,
+            idx INTEGER NOT NULL,
+            node_id INTEGER NOT NULL,
+            lon REAL,
+            lat REAL,
+            PRIMARY KEY (way_osm_id, idx)
+        )""")
+    connection.execute("CREATE TEMP TABLE osm_nodes (id INTEGER PRIMARY KEY, lon REAL, lat REAL)")
+    connection.execute("CREATE TEMP TABLE way_refs (way_osm_id INTEGER, idx INTEGER, node_id INTEGER)")
+
+def build_node_table(osm_path, db_file):
+    """
+    Stream the .osm file and write the node list of every highway to the
+    'way_nodes' table of db_file. Node coordinates are staged in a temporary
+    table, so memory use doesn't grow with the size of the extract.
+    """
+    connection = connect(db_file, 'rw')
+    create_node_tables(connection)
+    nodes, refs = [], []
+    n_ways = 0
+    root = None
+    for event, element in ET.iterparse(osm_path, events=('start', 'end')):
+        if event == 'start':
+            root = root if root is not None else element
+            continue
+        if element.tag == 'node':
+            nodes.append((int(element.get('id')), float(element.get('lon')), float(element.get('lat'))))
+            if len(nodes) >= BATCH_SIZE:
+                connection.executemany("INSERT OR REPLACE INTO osm_nodes VALUES (?, ?, ?)", nodes)
+                nodes = []
+        elif element.tag == 'way':
+            if any(tag.get('k') == 'highway' for tag in element.iter('tag')):
+                way_id = int(element.get('id'))
+                refs.extend((way_id, i, int(nd.get('ref'))) for i, nd in enumerate(element.iter('nd')))
+                n_ways += 1
+                if len(refs) >= BATCH_SIZE:
+                    connection.executemany("INSERT INTO way_refs VALUES (?, ?, ?)", refs)
+                    refs = []
+        else:
+            continue
+        # Drop parsed elements, including the root's references to them
+        element.clear()
+        root.clear()
+    connection.executemany("INSERT OR REPLACE INTO osm_nodes VALUES (?, ?, ?)", nodes)
+    connection.executemany("INSERT INTO way_refs VALUES (?, ?, ?)", refs)
+    connection.execute(f"""
+        INSERT OR REPLACE INTO {NODE_TABLE} (way_osm_id, idx, node_id, lon, lat)
+        SELECT r.way_osm_id, r.idx, r.node_id, n.lon, n.lat
+        FROM way_refs r LEFT JOIN osm_nodes n ON n.id = r.node_id
+    """)
+    connection.commit()
+    count = connection.execute(f"SELECT COUNT(*) FROM {NODE_TABLE}").fetchone()[0]
+    connection.close()
+    logger.info(f"Stored {count} nodes of {n_ways} ways in {db_file}:{NODE_TABLE}")
+
+def main(argv):
+    if len(argv) not in (2, 3):
+        raise Exception('args: path to .osm file, [path to database]')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if len(argv) == 3:
+        db_file = argv[2]
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        db_file = os.path.join(script_dir, 'socal_roads.sqlite')
+    build_node_table(argv[1], db_file)
+
+if __name__ == '__main__':
+    main(sys.argv)
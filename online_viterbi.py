@@ -0,0 +1,169 @@
+from collections import deque
+import numpy as np
+import metrics
+import AKF
+import MAD
+from emission_probability import GPS_SIGMA
+from road_index import lonlat_to_mercator, mercator_to_lonlat
+from viterbi import (RADIUS, N, WINDOW, _to_log_probs, _compute_candidates, _transition_step)
+
+# SUMMARY
+#--------------------
+# Streaming Viterbi for live vehicles. Observations are pushed one at a time
+# and matched segments are emitted as soon as they are decided:
+#   - convergence: when the backpointers of all surviving candidates meet in a
+#     common ancestor, the path up to that ancestor can no longer change.
+#   - lag: when more than 'lag' steps are undecided, the oldest ones are
+#     decided from the currently best candidate (fixed-lag smoothing).
+# The current step is always kept for the next transition. Only undecided
+# steps are kept, so memory is bounded by 'lag' steps of 'n'
+# candidates regardless of trip length.
+#
+# Each step is a list [segments, log_probs, backpointers, observation_index],
+# the same layout as the steps in viterbi.viterbi.
+
+class OnlineViterbi(object):
+
+    # 'graph': optional RoadGraph for routed transitions
+    # 'smooth': Kalman filter the positions before matching (AKF.KalmanFilter)
+    # 'adaptive_sigma': estimate this vehicle's GPS error from the distances
+    # of its decided matches (MAD.OnlineMAD) instead of using GPS_SIGMA
+    # 'emission_cache': optional emission_cache.EmissionCache, can be shared
+    # by the sessions of all vehicles
+    def __init__(self, radius=RADIUS, n=N, lag=WINDOW, graph=None, smooth=False, smooth_alpha=AKF.ALPHA,
+                 adaptive_sigma=False, emission_cache=None):
+        self.radius = radius
+        self.n = n
+        self.lag = lag
+        self.graph = graph
+        self.kalman = AKF.KalmanFilter(smooth_alpha, GPS_SIGMA**2) if smooth else None
+        self.sigma_estimator = MAD.OnlineMAD(GPS_SIGMA) if adaptive_sigma else None
+        self.emission_cache = emission_cache
+        self.steps = deque()
+        self.point = None
+        self.n_observations = 0
+
+    def push(self, observation):
+        """
+        Add one observation (lat, lon, course, speed). Returns the list of
+        segments decided by it, oldest first; every segment carries the index
+        of its observation in 'observation_index'.
+        """
+        t_obs_index = self.n_observations
+        self.n_observations += 1
+        if self.kalman is not None:
+            observation = self._filtered(observation)
+        sigma = self.sigma_estimator.sigma() if self.sigma_estimator is not None else GPS_SIGMA
+        segments, emission_probabilities, point = _compute_candidates(observation, t_obs_index, self.radius,
+                                                                      self.n, sigma, self.emission_cache)
+        if not segments:
+            return []
+
+        decided = []
+        log_emissions = _to_log_probs(emission_probabilities)
+        if self.steps:
+            prev_segments, prev_log_probs, _, _ = self.steps[-1]
+            log_probs, backpointers = _transition_step(self.point, point, prev_segments, prev_log_probs,
+                                                       segments, emission_probabilities, self.graph)
+            if np.all(log_probs == float('-inf')):
+                # No candidate is reachable: close the current path and restart here
+                decided = self.flush()
+                log_probs, backpointers = None, None
+        else:
+            log_probs, backpointers = None, None
+
+        if log_probs is None:
+            segments.directions[:] = 0
+            log_probs, backpointers = log_emissions, np.full(len(segments), -1)
+
+        # Renormalize so log-probabilities don't drift towards -inf on long trips
+        log_probs = log_probs - np.max(log_probs)
+        self.steps.append([segments, log_probs, backpointers, t_obs_index])
+        self.point = point
+
+        converged = self._convergence_point()
+        if converged is not None:
+            decided.extend(self._decide(*converged))
+        while len(self.steps) > max(self.lag, 1):
+            decided.extend(self._decide(0, self._best_ancestors()[0]))
+        return decided
+
+    def _filtered(self, observation):
+        x, y = self.kalman.update(lonlat_to_mercator(observation[1], observation[0]))
+        lon, lat = mercator_to_lonlat(x, y)
+        return (float(lat), float(lon)) + tuple(observation[2:])
+
+    def flush(self):
+        """Decide all remaining steps from the best current candidate and reset."""
+        decided = []
+        if self.steps:
+            decided = self._decide(len(self.steps) - 1, self._best_ancestors()[-1])
+        self.point = None
+        return decided
+
+    def __len__(self):
+        return len(self.steps)
+
+    # Newest step, other than the current one, at which all surviving
+    # candidates share one ancestor, as (position in self.steps, candidate
+    # index), or None.
+    def _convergence_point(self):
+        alive = np.nonzero(self.steps[-1][1] > float('-inf'))[0]
+        for k in range(len(self.steps) - 1, 0, -1):
+            backpointers = self.steps[k][2]
+            alive = np.unique(backpointers[alive])
+            alive = alive[alive >= 0]
+            if len(alive) == 0:
+                return None
+            if len(alive) == 1:
+                return k - 1, int(alive[0])
+        return None
+
+    # Candidate index at every undecided step on the path to the best current candidate
+    def _best_ancestors(self):
+        idx = int(np.argmax(self.steps[-1][1]))
+        ancestors = [idx]
+        for k in range(len(self.steps) - 1, 0, -1):
+            idx = int(self.steps[k][2][idx])
+            ancestors.append(idx)
+        return ancestors[::-1]
+
+    # Emit the path ending in candidate 'idx' of step 'position' and drop all
+    # steps up to and including that position.
+    def _decide(self, position, idx):
+        with metrics.timer('backtrack'):
+            path = self._decide_path(position, idx)
+        if self.sigma_estimator is not None:
+            for segment in path:
+                self.sigma_estimator.update(segment['distance'])
+        return path
+
+    def _decide_path(self, position, idx):
+        idx_decided = idx
+        path = []
+        for k in range(position, -1, -1):
+            segments, _, backpointers, t_obs_index = self.steps[k]
+            segment = segments.segment(idx)
+            idx = int(backpointers[idx])
+            segment['previous'] = idx if idx >= 0 else None
+            segment['observation_index'] = t_obs_index
+            path.append(segment)
+            if idx < 0:
+                break
+        for _ in range(position + 1):
+            self.steps.popleft()
+        if self.steps:
+            self._restrict_to(idx_decided)
+        return path[::-1]
+
+    # Candidates of the current step that don't descend from the decided
+    # candidate 'idx' can no longer win; the oldest remaining step then starts
+    # the undecided part of the path.
+    def _restrict_to(self, idx):
+        oldest = self.steps[0]
+        descends = oldest[2] == idx
+        oldest[2] = np.full(len(oldest[0]), -1)
+        for k in range(1, len(self.steps)):
+            backpointers = self.steps[k][2]
+            descends = np.where(backpointers >= 0, descends[backpointers], False)
+        self.steps[-1][1] = np.where(descends, self.steps[-1][1], float('-inf'))
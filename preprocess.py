@@ -0,0 +1,67 @@
+import math
+import numpy as np
+from road_index import lonlat_to_mercator
+
+# SUMMARY
+#--------------------
+# Thins a trace before matching. SensorLog records at 1 Hz also while the car
+# stands still, and every fix costs a full emission and transition step.
+#   - stationary collapse: a fix that is an exact duplicate of the last kept
+#     fix, or within STATIONARY_DISTANCE meters of it at a speed below
+#     STATIONARY_SPEED, is dropped;
+#   - downsampling (optional): a fix is only kept once the vehicle moved
+#     'min_distance' meters from the last kept fix, or its course changed by
+#     'min_heading_change' degrees.
+# The first and last fixes are always kept. Every dropped fix is assigned to
+# the last kept fix before it, so results computed for the kept fixes can be
+# expanded back to one value per original fix (expand).
+#
+# Usage:
+#   kept, fix_index = preprocess(observations, min_distance=10)
+#   ... match 'kept', one result per kept fix ...
+#   results = expand(kept_results, fix_index)
+
+STATIONARY_DISTANCE = 5.0  # meters
+STATIONARY_SPEED = 0.5     # m/s; SensorLog reports -1 for unknown speed
+
+def _heading_change(a, b):
+    diff = abs(a - b) % 360.0
+    return min(diff, 360.0 - diff)
+
+def preprocess(observations, collapse_stationary=True, min_distance=None, min_heading_change=None):
+    """
+    Returns the kept observations and 'fix_index', an int array with the
+    position in the kept list that every original fix is assigned to.
+    """
+    n = len(observations)
+    if n == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    lat = np.array([o[0] for o in observations], dtype=np.float64)
+    lon = np.array([o[1] for o in observations], dtype=np.float64)
+    x, y = lonlat_to_mercator(lon, lat)
+    x, y = x.tolist(), y.tolist()
+
+    fix_index = np.zeros(n, dtype=np.int64)
+    kept = [0]
+    for i in range(1, n):
+        last = kept[-1]
+        distance = math.hypot(x[i] - x[last], y[i] - y[last])
+        course, speed = observations[i][2], observations[i][3]
+        drop = False
+        if collapse_stationary:
+            drop = distance == 0.0 or (distance < STATIONARY_DISTANCE and 0 <= speed < STATIONARY_SPEED)
+        if not drop and (min_distance is not None or min_heading_change is not None):
+            far = min_distance is not None and distance >= min_distance
+            turned = (min_heading_change is not None and
+                      _heading_change(course, observations[last][2]) >= min_heading_change)
+            drop = not (far or turned)
+        if drop and i == n - 1 and distance > 0.0:
+            drop = False
+        if not drop:
+            kept.append(i)
+        fix_index[i] = len(kept) - 1
+    return [observations[i] for i in kept], fix_index
+
+def expand(kept_results, fix_index):
+    """One result per original fix, from one result per kept fix."""
+    return [kept_results[i] for i in fix_index.tolist()]
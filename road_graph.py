@@ -0,0 +1,165 @@
+import heapq
+from collections import OrderedDict
+import numpy as np
+import metrics
+import utils
+from segment_store import CandidateSet, endpoint_node_ids
+
+# SUMMARY
+#--------------------
+# Directed road graph for routed transition scores. Graph nodes are the
+# distinct segment endpoints of a RoadIndex (vertices with equal coordinates
+# are one node), every segment is an edge of its length, and segments of
+# oneway ways only get the forward edge. Adjacency is stored CSR-style:
+# the edges leaving node u are adj_targets/adj_weights[adj_offsets[u]:adj_offsets[u+1]].
+#
+# route_distances computes the network distance between the projections of
+# two consecutive observations on all N x M candidate pairs with a single
+# bounded Dijkstra search from all exit nodes of the previous candidates at
+# once (one label per source). The distances from each source node are
+# cached, so a node that was a source in the previous step isn't searched
+# again.
+
+ROUTE_BOUND_FACTOR = 2.0    # search up to this many times the GPS displacement...
+ROUTE_BOUND_SLACK = 100.0   # ...plus this many meters
+CACHE_SIZE = 4096           # source nodes whose distances are kept
+
+INF = float('inf')
+
+
+class RoadGraph(object):
+
+    def __init__(self, index, cache_size=CACHE_SIZE):
+        vertex_keys = endpoint_node_ids(np.asarray(index.vertices))
+        self.node_keys, vertex_nodes = np.unique(vertex_keys, return_inverse=True)
+        vertex_nodes = vertex_nodes.reshape(-1)
+        seg_start = np.asarray(index.seg_start)
+        u = vertex_nodes[seg_start]
+        v = vertex_nodes[seg_start + 1]
+        delta = np.asarray(index.vertices)[seg_start + 1] - np.asarray(index.vertices)[seg_start]
+        lengths = np.hypot(delta[:, 0], delta[:, 1])
+        twoway = ~np.asarray(index.oneway)[np.asarray(index.seg_way)]
+        sources = np.concatenate((u, v[twoway]))
+        targets = np.concatenate((v, u[twoway]))
+        weights = np.concatenate((lengths, lengths[twoway]))
+        order = np.argsort(sources, kind='stable')
+        self.adj_targets = targets[order]
+        self.adj_weights = weights[order]
+        self.adj_offsets = np.searchsorted(sources[order], np.arange(len(self.node_keys) + 1))
+        # oneway flag by way id
+        way_ids = np.asarray(index.way_ids)
+        way_order = np.argsort(way_ids, kind='stable')
+        self.sorted_way_ids = way_ids[way_order]
+        self.sorted_oneway = np.asarray(index.oneway)[way_order]
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # source node -> (bound, {node: distance})
+
+    def __len__(self):
+        return len(self.node_keys)
+
+    # Graph node of each point (-1 if the point isn't a road vertex)
+    def nodes(self, points):
+        keys = endpoint_node_ids(points)
+        pos = np.minimum(np.searchsorted(self.node_keys, keys), len(self.node_keys) - 1)
+        return np.where(self.node_keys[pos] == keys, pos, -1)
+
+    def oneway(self, way_ids):
+        pos = np.minimum(np.searchsorted(self.sorted_way_ids, way_ids), len(self.sorted_way_ids) - 1)
+        return np.where(self.sorted_way_ids[pos] == way_ids, self.sorted_oneway[pos], False)
+
+    def shortest_distances(self, sources, bound):
+        """
+        {source: {node: distance}} for every node within 'bound' meters of each
+        source node. Sources searched before with at least this bound come
+        from the cache; all others are expanded together in one search.
+        """
+        results = {}
+        pending = []
+        for source in set(sources):
+            cached = self._cache.get(source)
+            if cached is not None and cached[0] >= bound:
+                self._cache.move_to_end(source)
+                results[source] = cached[1]
+            else:
+                pending.append(source)
+        metrics.count('route_cache_hits', len(results))
+        metrics.count('route_cache_misses', len(pending))
+        if pending:
+            results.update(self._bounded_search(pending, bound))
+        return results
+
+    # Multi-source Dijkstra: one heap, each entry labelled with its source
+    def _bounded_search(self, sources, bound):
+        settled = {source: {} for source in sources}
+        heap = [(0.0, source, source) for source in sources]
+        heapq.heapify(heap)
+        offsets, targets, weights = self.adj_offsets, self.adj_targets, self.adj_weights
+        while heap:
+            dist, source, node = heapq.heappop(heap)
+            if dist > bound:
+                break
+            distances = settled[source]
+            if node in distances:
+                continue
+            distances[node] = dist
+            for k in range(offsets[node], offsets[node + 1]):
+                target = int(targets[k])
+                if target not in distances:
+                    heapq.heappush(heap, (dist + weights[k], source, target))
+        for source, distances in settled.items():
+            self._cache[source] = (bound, distances)
+            self._cache.move_to_end(source)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return settled
+
+    def route_distances(self, obs1, obs2, segments1, segments2, bound=None):
+        """
+        (N, M) network distances from the projection of obs1 on every segment
+        in segments1 to the projection of obs2 on every segment in segments2.
+        inf where no route within the bound exists.
+        """
+        segments1 = CandidateSet.from_segments(segments1)
+        segments2 = CandidateSet.from_segments(segments2)
+        if bound is None:
+            bound = ROUTE_BOUND_FACTOR * utils.euclidean_dist(obs1, obs2) + ROUTE_BOUND_SLACK
+        lengths1 = np.hypot(*(segments1.endpoints[:, 1] - segments1.endpoints[:, 0]).T)
+        lengths2 = np.hypot(*(segments2.endpoints[:, 1] - segments2.endpoints[:, 0]).T)
+        f1 = utils.get_projection_fractions(segments1.endpoints, obs1)
+        f2 = utils.get_projection_fractions(segments2.endpoints, obs2)
+        oneway1 = self.oneway(segments1.way_ids)
+        oneway2 = self.oneway(segments2.way_ids)
+
+        # Leave segment 1 through its end node, or its start node if it is two-way.
+        # Enter segment 2 through its start node, or its end node if it is two-way.
+        exit_nodes = self.nodes(segments1.endpoints[:, ::-1])                        # (N,2): end, start
+        exit_costs = np.column_stack(((1 - f1) * lengths1, np.where(oneway1, INF, f1 * lengths1)))
+        entry_nodes = self.nodes(segments2.endpoints)                                # (M,2): start, end
+        entry_costs = np.column_stack((f2 * lengths2, np.where(oneway2, INF, (1 - f2) * lengths2)))
+
+        sources = [int(node) for node in np.unique(exit_nodes) if node >= 0]
+        targets = np.unique(entry_nodes)
+        targets = targets[targets >= 0]
+        trees = self.shortest_distances(sources, bound)
+        # node-to-node distances between all exit and entry nodes
+        table = np.full((len(sources), len(targets)), INF)
+        for row, source in enumerate(sources):
+            distances = trees[source]
+            table[row] = [distances.get(int(target), INF) for target in targets]
+        source_pos = np.searchsorted(sources, exit_nodes) if sources else np.zeros_like(exit_nodes)
+        target_pos = np.searchsorted(targets, entry_nodes)
+        node_dist = np.full((len(segments1), 2, len(segments2), 2), INF)
+        if len(sources) and len(targets):
+            valid = (exit_nodes >= 0)[:, :, None, None] & (entry_nodes >= 0)[None, None, :, :]
+            lookup = table[np.minimum(source_pos, len(sources) - 1)[:, :, None, None],
+                           np.minimum(target_pos, len(targets) - 1)[None, None, :, :]]
+            node_dist = np.where(valid, lookup, INF)
+        routes = exit_costs[:, :, None, None] + node_dist + entry_costs[None, None, :, :]
+        dist = routes.min(axis=(1, 3))
+
+        # Both projections on the same segment: move along it directly
+        same = ((segments1.node_ids[:, None, 0] == segments2.node_ids[None, :, 0]) &
+                (segments1.node_ids[:, None, 1] == segments2.node_ids[None, :, 1]))
+        along = (f2[None, :] - f1[:, None]) * lengths1[:, None]
+        direct = np.where(along >= 0, along, np.where(oneway1[:, None], INF, -along))
+        return np.where(same, np.minimum(dist, direct), dist)
@@ -0,0 +1,390 @@
+import json
+import math
+import os
+from contextlib import contextmanager
+import numpy as np
+import metrics
+
+# SUMMARY
+#--------------------
+# In-memory road network index. The whole 'lines' table is loaded once, every
+# vertex is projected to EPSG:3857 in one vectorized pass and the segments are
+# hashed into a uniform grid. Radius queries then only touch a handful of grid
+# cells instead of issuing a SQL query per GPS fix.
+#
+# Storage layout (all NumPy arrays):
+#   way_ids      (W,)    OSM ids of the ways
+#   oneway       (W,)    bool, True if the way is oneway
+#   way_offsets  (W+1,)  vertices of way w are vertices[way_offsets[w]:way_offsets[w+1]]
+#   vertices     (V,2)   projected (x, y) coordinates of all vertices
+#
+# The grid is stored CSR-style: cell_keys is sorted, and the segments in cell
+# cell_keys[c] are cell_items[cell_offsets[c]:cell_offsets[c+1]].
+
+EARTH_RADIUS = 6378137.0
+DEFAULT_CELL_SIZE = 250.0  # meters
+CORRIDOR_CHUNK = 60  # fixes per corridor box, see corridor_boxes
+# Arrays written by RoadIndex.save, including the derived segment and grid arrays
+SAVED_ARRAYS = ('way_ids', 'oneway', 'way_offsets', 'vertices', 'seg_start', 'seg_way',
+                'seg_min', 'seg_max', 'cell_keys', 'cell_offsets', 'cell_items')
+
+# Spherical (Web) Mercator, identical to pyproj's EPSG:4326 -> EPSG:3857.
+# Works on scalars and on NumPy arrays.
+def lonlat_to_mercator(lon, lat):
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(math.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+def mercator_to_lonlat(x, y):
+    lon = np.degrees(np.asarray(x) / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y) / EARTH_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+def _cell_keys(ix, iy):
+    # |iy| < 2**31 for any sane cell size, so the key is unique
+    return ix.astype(np.int64) * (1 << 32) + iy.astype(np.int64)
+
+# Buffered EPSG:3857 bounding boxes covering a trace of (lat, lon, ...)
+# observations: one box per 'chunk' consecutive fixes, so that a long diagonal
+# trip isn't covered by one huge box. Consecutive boxes share a fix.
+def corridor_boxes(observations, buffer, chunk=CORRIDOR_CHUNK):
+    lat = np.array([o[0] for o in observations], dtype=np.float64)
+    lon = np.array([o[1] for o in observations], dtype=np.float64)
+    x, y = lonlat_to_mercator(lon, lat)
+    boxes = []
+    for i in range(0, len(x), chunk):
+        bx, by = x[i:i + chunk + 1], y[i:i + chunk + 1]
+        boxes.append((float(bx.min() - buffer), float(by.min() - buffer),
+                      float(bx.max() + buffer), float(by.max() + buffer)))
+    return boxes
+
+# Serve all db_wrapper.query_ways_within_radius calls inside the block from
+# the ways around 'observations', prefetched in bulk. Queries must stay
+# within 'buffer' meters of a fix (use at least the max_distance of
+# the nearest segment search).
+@contextmanager
+def prefetched_corridor(observations, buffer, cell_size=DEFAULT_CELL_SIZE):
+    import db_wrapper
+    index = RoadIndex.from_corridor(observations, buffer, cell_size)
+    previous = db_wrapper.set_road_index(index)
+    try:
+        yield index
+    finally:
+        db_wrapper.set_road_index(previous)
+
+
+class RoadIndex(object):
+
+    def __init__(self, way_ids, oneway, way_offsets, vertices, cell_size=DEFAULT_CELL_SIZE):
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)
+        self.oneway = np.asarray(oneway, dtype=bool)
+        self.way_offsets = np.asarray(way_offsets, dtype=np.int64)
+        self.vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self.cell_size = float(cell_size)
+        self._build_segments()
+        self._build_grid()
+
+    # Build an index from ways in the format returned by
+    # db_wrapper.query_ways_within_radius: {'osm_id', 'points', 'oneway'}
+    # with points already in EPSG:3857.
+    @classmethod
+    def from_ways(cls, ways, cell_size=DEFAULT_CELL_SIZE):
+        ways = [way for way in ways if len(way['points']) > 0]
+        lengths = [len(way['points']) for way in ways]
+        way_offsets = np.zeros(len(ways) + 1, dtype=np.int64)
+        way_offsets[1:] = np.cumsum(lengths)
+        if ways:
+            vertices = np.concatenate([np.asarray(way['points'], dtype=np.float64).reshape(-1, 2) for way in ways])
+        else:
+            vertices = np.empty((0, 2))
+        return cls([way['osm_id'] for way in ways], [way['oneway'] for way in ways],
+                   way_offsets, vertices, cell_size)
+
+    # Load the complete 'lines' table of the SpatiaLite database, through a
+    # db_wrapper.ConnectionPool (by default db_wrapper.pool).
+    @classmethod
+    def from_database(cls, pool=None, cell_size=DEFAULT_CELL_SIZE):
+        import db_wrapper
+        pool = pool if pool is not None else db_wrapper.pool
+        rows = pool.execute(f"SELECT osm_id, oneway, AsBinary(geometry) FROM {db_wrapper.LINE_TABLE}")
+        return cls._from_rows([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], cell_size)
+
+    # Load only the ways around a trace, in a few bulk R-tree queries.
+    # Every radius query within 'buffer' meters of a fix is then complete.
+    @classmethod
+    def from_corridor(cls, observations, buffer, cell_size=DEFAULT_CELL_SIZE):
+        return cls.from_corridors([observations], buffer, cell_size)
+
+    # Same for several traces at once, e.g. all files of a batch job
+    @classmethod
+    def from_corridors(cls, traces, buffer, cell_size=DEFAULT_CELL_SIZE):
+        import db_wrapper
+        boxes = [box for observations in traces for box in corridor_boxes(observations, buffer)]
+        return cls.from_ways(db_wrapper.query_ways_in_boxes(boxes), cell_size)
+
+    # Load a database written by ingest_osm.py. The segments are already in
+    # EPSG:3857, so no geometry is parsed or projected.
+    @classmethod
+    def from_ingested(cls, db_file, cell_size=DEFAULT_CELL_SIZE):
+        from ingest_osm import SEGMENT_TABLE
+        from node_table import connect
+        connection = connect(db_file)
+        try:
+            rows = connection.execute(f"""
+                SELECT way_osm_id, x0, y0, x1, y1, oneway FROM {SEGMENT_TABLE}
+                ORDER BY way_osm_id, idx""").fetchall()
+        finally:
+            connection.close()
+        rows = np.array(rows, dtype=np.float64).reshape(-1, 6)
+        seg_ways = rows[:, 0].astype(np.int64)
+        # first segment of every way, and the number of segments per way
+        firsts = np.nonzero(np.r_[True, seg_ways[1:] != seg_ways[:-1]])[0] if len(rows) else np.empty(0, dtype=np.int64)
+        counts = np.diff(np.append(firsts, len(rows)))
+        # vertices of a way: the start of each of its segments plus the end of the last one
+        lasts = firsts + counts - 1
+        is_last = np.zeros(len(rows), dtype=bool)
+        is_last[lasts] = True
+        repeat = np.where(is_last, 2, 1)
+        vertices = np.repeat(rows[:, 1:3], repeat, axis=0)
+        vertices[np.cumsum(repeat)[is_last] - 1] = rows[is_last, 3:5]
+        way_offsets = np.zeros(len(firsts) + 1, dtype=np.int64)
+        way_offsets[1:] = np.cumsum(counts + 1)
+        return cls(seg_ways[firsts], rows[firsts, 5] != 0, way_offsets, vertices, cell_size)
+
+    @classmethod
+    def _from_rows(cls, osm_ids, oneways, wkb_geometries, cell_size):
+        from db_wrapper import decode_wkb_lines
+        way_ids, oneway, lonlat = [], [], []
+        for osm_id, ow, coords in zip(osm_ids, oneways, decode_wkb_lines(wkb_geometries)):
+            osm_id = int(osm_id)
+            if osm_id < 0 or len(coords) == 0:
+                continue
+            way_ids.append(osm_id)
+            oneway.append(str(ow).lower() in ['yes', '1', 'true'])
+            lonlat.append(coords)
+        way_offsets = np.zeros(len(lonlat) + 1, dtype=np.int64)
+        way_offsets[1:] = np.cumsum([len(c) for c in lonlat])
+        lonlat = np.concatenate(lonlat) if lonlat else np.empty((0, 2))
+        x, y = lonlat_to_mercator(lonlat[:, 0], lonlat[:, 1])
+        return cls(way_ids, oneway, way_offsets, np.column_stack((x, y)), cell_size)
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    # Write all arrays as .npy files to 'directory', so that other processes
+    # can load() them memory-mapped instead of rebuilding the index.
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in SAVED_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump({'cell_size': self.cell_size}, f)
+
+    # With mmap=True the arrays are read-only memory maps, so every process
+    # loading the same directory shares one copy in the OS page cache.
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls.__new__(cls)
+        index.cell_size = float(meta['cell_size'])
+        for name in SAVED_ARRAYS:
+            setattr(index, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None))
+        return index
+
+    # A segment is the line between two consecutive vertices of the same way.
+    # seg_start[s] is the index in vertices of the first endpoint of segment s.
+    def _build_segments(self):
+        n_vertices = len(self.vertices)
+        is_start = np.ones(n_vertices, dtype=bool)
+        # last vertex of every way starts no segment
+        last = self.way_offsets[1:] - 1
+        is_start[last[last >= 0]] = False
+        self.seg_start = np.nonzero(is_start)[0]
+        self.seg_way = np.searchsorted(self.way_offsets, self.seg_start, side='right') - 1
+        p0 = self.vertices[self.seg_start]
+        p1 = self.vertices[self.seg_start + 1]
+        self.seg_min = np.minimum(p0, p1)
+        self.seg_max = np.maximum(p0, p1)
+
+    def _build_grid(self):
+        cs = self.cell_size
+        ix0 = np.floor(self.seg_min[:, 0] / cs).astype(np.int64)
+        iy0 = np.floor(self.seg_min[:, 1] / cs).astype(np.int64)
+        nx = np.floor(self.seg_max[:, 0] / cs).astype(np.int64) - ix0 + 1
+        ny = np.floor(self.seg_max[:, 1] / cs).astype(np.int64) - iy0 + 1
+        counts = nx * ny
+        # Enumerate every (segment, cell) pair covered by the segment's bbox
+        seg_rep = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        keys = _cell_keys(ix0[seg_rep] + local // ny[seg_rep], iy0[seg_rep] + local % ny[seg_rep])
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.cell_items = seg_rep[order]
+        self.cell_keys, starts = np.unique(keys, return_index=True)
+        self.cell_offsets = np.append(starts, len(keys)).astype(np.int64)
+
+    # Indices of the segments whose bounding boxes intersect the query box
+    def _segments_in_box(self, min_x, min_y, max_x, max_y):
+        cs = self.cell_size
+        ix = np.arange(math.floor(min_x / cs), math.floor(max_x / cs) + 1)
+        iy = np.arange(math.floor(min_y / cs), math.floor(max_y / cs) + 1)
+        keys = _cell_keys(np.repeat(ix, len(iy)), np.tile(iy, len(ix)))
+        pos = np.searchsorted(self.cell_keys, keys)
+        found = pos < len(self.cell_keys)
+        pos, keys = pos[found], keys[found]
+        pos = pos[self.cell_keys[pos] == keys]
+        if len(pos) == 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.concatenate([self.cell_items[self.cell_offsets[c]:self.cell_offsets[c + 1]] for c in pos])
+        candidates = np.unique(candidates)
+        mask = ((self.seg_min[candidates, 0] <= max_x) & (self.seg_max[candidates, 0] >= min_x) &
+                (self.seg_min[candidates, 1] <= max_y) & (self.seg_max[candidates, 1] >= min_y))
+        return candidates[mask]
+
+    # Segments in the cells of ring r around cell (cx, cy): the cells at
+    # Chebyshev distance r
+    def _segments_in_ring(self, cx, cy, r):
+        if r == 0:
+            ix, iy = np.array([cx]), np.array([cy])
+        else:
+            side = np.arange(-r, r + 1)
+            inner = side[1:-1]
+            ix = cx + np.concatenate((side, side, np.full(len(inner), -r), np.full(len(inner), r)))
+            iy = cy + np.concatenate((np.full(len(side), -r), np.full(len(side), r), inner, inner))
+        keys = _cell_keys(ix, iy)
+        pos = np.searchsorted(self.cell_keys, keys)
+        found = pos < len(self.cell_keys)
+        pos, keys = pos[found], keys[found]
+        pos = pos[self.cell_keys[pos] == keys]
+        if len(pos) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.cell_items[self.cell_offsets[c]:self.cell_offsets[c + 1]] for c in pos])
+
+    def _segment_endpoints(self, segments):
+        starts = self.seg_start[segments]
+        return np.stack((self.vertices[starts], self.vertices[starts + 1]), axis=1)
+
+    # Half-size of the smallest search box around (x, y) that intersects the
+    # bounding box of each of the given segments
+    def _box_distances(self, segments, x, y):
+        dx = np.maximum(np.maximum(self.seg_min[segments, 0] - x, x - self.seg_max[segments, 0]), 0)
+        dy = np.maximum(np.maximum(self.seg_min[segments, 1] - y, y - self.seg_max[segments, 1]), 0)
+        return np.maximum(dx, dy)
+
+    # _box_distances of the k-th nearest segment, or inf if fewer than k are
+    # within max_distance. Searches the grid ring by ring: after ring r every
+    # segment whose box is closer than r cells plus the distance from the
+    # point to the border of its own cell has been seen.
+    def _kth_box_distance(self, x, y, k, max_distance):
+        cs = self.cell_size
+        cx, cy = math.floor(x / cs), math.floor(y / cs)
+        border = min(x - cx * cs, (cx + 1) * cs - x, y - cy * cs, (cy + 1) * cs - y)
+        seen = []
+        r = 0
+        while True:
+            seen.append(self._segments_in_ring(cx, cy, r))
+            covered = r * cs + border
+            # a segment spanning several cells is found in each of them
+            distances = self._box_distances(np.unique(np.concatenate(seen)), x, y)
+            if np.sum(distances <= min(covered, max_distance)) >= k:
+                return float(np.partition(distances, k - 1)[k - 1])
+            if covered >= max_distance:
+                return math.inf
+            r += 1
+
+    # Segments in the first of the boxes radius, 2 * radius, 4 * radius, ...
+    # (capped at max_distance) that holds at least k of them. A cap within
+    # one cell is served from the box at max_distance, in a single grid
+    # lookup; larger caps search ring by ring.
+    def _nearest_segments(self, x, y, k, radius, max_distance):
+        if max_distance <= self.cell_size:
+            segments = self._segments_in_box(x - max_distance, y - max_distance, x + max_distance, y + max_distance)
+            distances = self._box_distances(segments, x, y)
+            kth = float(np.partition(distances, k - 1)[k - 1]) if len(segments) >= k else math.inf
+        else:
+            segments = None
+            kth = self._kth_box_distance(x, y, k, max_distance)
+        reach = radius
+        while reach < kth and reach < max_distance:
+            reach = min(2 * reach, max_distance)
+        if segments is None:
+            return self._segments_in_box(x - reach, y - reach, x + reach, y + reach)
+        # the same test as _segments_in_box, on the segments of the larger box
+        mask = ((self.seg_min[segments, 0] <= x + reach) & (self.seg_max[segments, 0] >= x - reach) &
+                (self.seg_min[segments, 1] <= y + reach) & (self.seg_max[segments, 1] >= y - reach))
+        return segments[mask]
+
+    def way_points(self, w):
+        return self.vertices[self.way_offsets[w]:self.way_offsets[w + 1]]
+
+    def query_segments_within_radius(self, lat, lon, radius):
+        """
+        Same contract as db_wrapper.query_segments_within_radius: returns the
+        point in EPSG:3857 and only the segments whose boxes intersect the
+        search box, packed as in segment_store.pack_way_segments, or
+        (None, None) if there are none.
+        """
+        from geometry_cache import segment_angles
+        merc_x, merc_y = lonlat_to_mercator(lon, lat)
+        merc_x, merc_y = float(merc_x), float(merc_y)
+        segments = self._segments_in_box(merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        if len(segments) == 0:
+            return None, None
+        starts = self.seg_start[segments]
+        ways = self.seg_way[segments]
+        endpoints = np.stack((self.vertices[starts], self.vertices[starts + 1]), axis=1)
+        return (merc_x, merc_y), {'endpoints': endpoints,
+                                  'angles': segment_angles(endpoints),
+                                  'way_ids': self.way_ids[ways],
+                                  'index_in_way': starts - self.way_offsets[ways],
+                                  'oneway': self.oneway[ways]}
+
+    def query_nearest_segments(self, lat, lon, k, radius, max_distance):
+        """
+        Like query_segments_within_radius, but if fewer than k segments are
+        found within 'radius', returns those of the first box of 2 * radius,
+        4 * radius, ... (never beyond 'max_distance') that holds k of them:
+        the boxes db_wrapper.query_nearest_segments queries one by one,
+        found in one pass. Returns (None, None) if the box at
+        'max_distance' holds no segment.
+        """
+        from geometry_cache import segment_angles
+        merc_x, merc_y = lonlat_to_mercator(lon, lat)
+        merc_x, merc_y = float(merc_x), float(merc_y)
+        segments = self._segments_in_box(merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        if len(segments) < k and max_distance > radius:
+            metrics.count('expanded')
+            segments = self._nearest_segments(merc_x, merc_y, k, radius, max_distance)
+        if len(segments) == 0:
+            return None, None
+        ways = self.seg_way[segments]
+        endpoints = self._segment_endpoints(segments)
+        return (merc_x, merc_y), {'endpoints': endpoints,
+                                  'angles': segment_angles(endpoints),
+                                  'way_ids': self.way_ids[ways],
+                                  'index_in_way': self.seg_start[segments] - self.way_offsets[ways],
+                                  'oneway': self.oneway[ways]}
+
+    def query_ways_within_radius(self, lat, lon, radius):
+        """
+        Same contract as db_wrapper.query_ways_within_radius: returns the point
+        in EPSG:3857 and the ways whose segments intersect the search box, or
+        (None, None) if there are none.
+        """
+        merc_x, merc_y = lonlat_to_mercator(lon, lat)
+        merc_x, merc_y = float(merc_x), float(merc_y)
+        segments = self._segments_in_box(merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        if len(segments) == 0:
+            return None, None
+        from geometry_cache import WAY_CACHE, WayGeometry
+        ways = []
+        for w in np.unique(self.seg_way[segments]):
+            osm_id = int(self.way_ids[w])
+            geometry = WAY_CACHE.get(osm_id)
+            if geometry is None:
+                geometry = WAY_CACHE.put(WayGeometry(osm_id, bool(self.oneway[w]), points=self.way_points(w)))
+            ways.append({'osm_id': osm_id, 'points': geometry.point_tuples(), 'oneway': bool(self.oneway[w]),
+                         'geometry': geometry})
+        return (merc_x, merc_y), ways
@@ -0,0 +1,136 @@
+import numpy as np
+from geometry_cache import segment_angles
+
+# SUMMARY
+#--------------------
+# Compact, array-backed storage of the candidate segments of one DP step.
+# Instead of one dict per candidate, a CandidateSet keeps a few small arrays:
+#   way_ids          (K,)    OSM id of the way
+#   index_in_way     (K,)    index of the segment in its way
+#   endpoints        (K,2,2) segment endpoints in EPSG:3857
+#   node_ids         (K,2)   integer ids of the start and end node
+#   distances, distance_scores, tangent_scores (K,)
+#   directions       (K,)    1 / -1 traversal direction, 0 if unknown
+#
+# Node ids are derived from the endpoint coordinates rounded to
+# 1/NODE_RESOLUTION meters, so equal endpoints always get equal ids and the
+# direction and backtrack checks are integer comparisons. With centimeter
+# resolution both rounded EPSG:3857 coordinates fit in 32 bits each.
+#
+# Code that wants the old dict representation uses segment(i), which returns
+# {'way_osm_id', 'index_in_way', 'endpoints', 'direction', 'distance_score',
+#  'tangent_score', 'distance'}.
+
+NODE_RESOLUTION = 100.0  # node ids per meter
+
+def endpoint_node_ids(points):
+    """Integer ids for points of shape (..., 2) in EPSG:3857."""
+    q = np.round(np.asarray(points, dtype=np.float64) * NODE_RESOLUTION).astype(np.int64) + (1 << 31)
+    q = q.astype(np.uint64)
+    return ((q[..., 0] << np.uint64(32)) | q[..., 1]).view(np.int64)
+
+
+# Pack the segments of all ways into flat arrays, so that emission scores are
+# computed for all K candidate segments at once:
+#   endpoints     (K,2,2) segment endpoints
+#   angles        (K,)    angle of the tangent of each segment
+#   way_ids       (K,)    OSM id of the way the segment belongs to
+#   index_in_way  (K,)    index of the segment in its way
+#   oneway        (K,)    True if the way is oneway
+# Ways coming from db_wrapper carry their cached 'geometry' (see
+# geometry_cache.py) with segments and angles already computed.
+def pack_way_segments(ways):
+    endpoints, angles, way_ids, index_in_way, oneway = [], [], [], [], []
+    for way in ways:
+        geometry = way.get('geometry')
+        if geometry is not None:
+            segments, way_angles = geometry.segments, geometry.angles
+        else:
+            points = np.asarray(way['points'], dtype=np.float64).reshape(-1, 2)
+            segments = np.stack((points[:-1], points[1:]), axis=1)
+            way_angles = segment_angles(segments)
+        n_segments = len(segments)
+        if n_segments < 1:
+            continue
+        endpoints.append(segments)
+        angles.append(way_angles)
+        way_ids.append(np.full(n_segments, way['osm_id'], dtype=np.int64))
+        index_in_way.append(np.arange(n_segments))
+        oneway.append(np.full(n_segments, bool(way['oneway'])))
+    if not endpoints:
+        return None
+    return {'endpoints': np.concatenate(endpoints),
+            'angles': np.concatenate(angles),
+            'way_ids': np.concatenate(way_ids),
+            'index_in_way': np.concatenate(index_in_way),
+            'oneway': np.concatenate(oneway)}
+
+# Only the packed segments whose bounding boxes intersect the query box, the
+# same test as RoadIndex._segments_in_box. Returns None if there are none.
+def segments_in_box(packed, min_x, min_y, max_x, max_y):
+    if packed is None:
+        return None
+    endpoints = packed['endpoints']
+    seg_min, seg_max = endpoints.min(axis=1), endpoints.max(axis=1)
+    mask = ((seg_min[:, 0] <= max_x) & (seg_max[:, 0] >= min_x) &
+            (seg_min[:, 1] <= max_y) & (seg_max[:, 1] >= min_y))
+    if not mask.any():
+        return None
+    return {field: values[mask] for field, values in packed.items()}
+
+
+class CandidateSet(object):
+    __slots__ = ('way_ids', 'index_in_way', 'endpoints', 'node_ids', 'distances',
+                 'distance_scores', 'tangent_scores', 'directions')
+
+    def __init__(self, way_ids, index_in_way, endpoints, distances=None, distance_scores=None,
+                 tangent_scores=None, directions=None, node_ids=None):
+        k = len(way_ids)
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)
+        self.index_in_way = np.asarray(index_in_way, dtype=np.int32)
+        self.endpoints = np.asarray(endpoints, dtype=np.float64).reshape(k, 2, 2)
+        self.node_ids = endpoint_node_ids(self.endpoints) if node_ids is None else node_ids
+        self.distances = np.zeros(k) if distances is None else np.asarray(distances, dtype=np.float64)
+        self.distance_scores = np.zeros(k) if distance_scores is None else np.asarray(distance_scores, dtype=np.float64)
+        self.tangent_scores = np.zeros(k) if tangent_scores is None else np.asarray(tangent_scores, dtype=np.float64)
+        self.directions = np.zeros(k, dtype=np.int8) if directions is None else np.asarray(directions, dtype=np.int8)
+
+    # Build from the old list-of-dicts representation
+    @classmethod
+    def from_segments(cls, segments):
+        if isinstance(segments, cls):
+            return segments
+        return cls([s['way_osm_id'] for s in segments], [s['index_in_way'] for s in segments],
+                   [s['endpoints'] for s in segments],
+                   [s.get('distance', 0.0) for s in segments],
+                   [s.get('distance_score', 0.0) for s in segments],
+                   [s.get('tangent_score', 0.0) for s in segments],
+                   [s.get('direction') or 0 for s in segments])
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    def take(self, indices):
+        """The candidates at 'indices', as a new CandidateSet."""
+        return CandidateSet(self.way_ids[indices], self.index_in_way[indices], self.endpoints[indices],
+                            self.distances[indices], self.distance_scores[indices],
+                            self.tangent_scores[indices], self.directions[indices], self.node_ids[indices])
+
+    def segment(self, i):
+        """Candidate i as a segment dict."""
+        start, end = self.endpoints[i].tolist()
+        direction = int(self.directions[i])
+        return {'way_osm_id': int(self.way_ids[i]), 'index_in_way': int(self.index_in_way[i]),
+                'endpoints': (tuple(start), tuple(end)), 'direction': direction if direction else None,
+                'distance_score': float(self.distance_scores[i]), 'tangent_score': float(self.tangent_scores[i]),
+                'distance': float(self.distances[i])}
+
+    def __getitem__(self, i):
+        return self.segment(i)
+
+    def __iter__(self):
+        return (self.segment(i) for i in range(len(self)))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.__slots__)
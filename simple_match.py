@@ -1,7 +1,6 @@
-import re
-import sys
-from plot_gps_data import read_gps_file
-from db_wrapper import query_ways_within_radius, get_node_id
+from gps_reader import read_gps_columns
+import node_table
+from db_wrapper import query_ways_within_radius
 from emission_probability import _add_distances, _add_segments
 
 DEFAULT_MAX_DISTANCE = 50
@@ -9,15 +8,14 @@ DEFAULT_MAX_DISTANCE = 50
 # Simple map matching algorithm that picks the road segment closest to the observation
 def simple_match(filename, **kwargs):
     max_distance = kwargs['max_distance'] if 'max_distance' in kwargs else DEFAULT_MAX_DISTANCE
-    with open(filename, 'r') as f:
-        data = read_gps_file(f, delimiter=',')
-    points = zip(data['lat'], data['long'])
+    data = read_gps_columns(filename, ('lat', 'long'))
+    points = list(zip(data['lat'].tolist(), data['long'].tolist()))
     matches = []
     for i, point in enumerate(points):
         # Don't query the same point twice
         if i==0 or point != points[i-1]:
             point_merc, ways = query_ways_within_radius(point[0], point[1], max_distance)
-            min_dist = sys.maxint
+            min_dist = float('inf')
             min_way = None
             min_idx = None
             if ways:
@@ -47,19 +45,8 @@ def remove_consecutive_duplicates(node_ids):
 
 # Get the node ids of the start and endpoints of the nodes
 def get_node_ids(matches):
-    node_ids = []
-    for i, match in enumerate(matches):
-        if match['way'] is None:
-            node_ids.append(None)
-            continue
-        # Don't query the same point twice
-        if i == 0 or match['way'] != matches[i-1]['way'] or match['index_of_segment'] != matches[i-1]['index_of_segment']:
-            start_node = get_node_id(match['way'], match['index_of_segment'])
-            start_node = re.findall(r'\d+', str(start_node))[0]
-            end_node = get_node_id(match['way'], match['index_of_segment'] + 1)
-            end_node = re.findall(r'\d+', str(end_node))[0]
-        node_ids.append((start_node, end_node))
-    return node_ids
+    path = [{'way_osm_id': match['way'], 'index_in_way': match['index_of_segment']} for match in matches]
+    return node_table.table_for_path(path).resolve_path(path)
  
 def write_to_file(node_ids, filename):
     with open(filename, 'w') as f:
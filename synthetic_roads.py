@@ -0,0 +1,128 @@
+from contextlib import contextmanager
+import numpy as np
+from road_index import RoadIndex, lonlat_to_mercator, mercator_to_lonlat
+from node_table import NodeTable
+from segment_store import endpoint_node_ids
+
+# SUMMARY
+#--------------------
+# Generated road networks, so the matcher can run (and be benchmarked)
+# without the SpatiaLite database. A network covers an EPSG:3857 bounding box
+# with
+#   - a street grid: straight two-way streets every 'grid_spacing' meters,
+#     with a vertex at every intersection, so the grid is a connected graph,
+#     and every ONEWAY_EVERY-th street oneway;
+#   - curved arterials: long sinusoidal roads across the box, with a vertex
+#     every ARTERIAL_VERTEX_SPACING meters;
+#   - optionally the road the trace was driven on: its fixes thinned to one
+#     vertex every TRACE_VERTEX_SPACING meters and cut into ways of
+#     TRACE_WAY_VERTICES vertices. Without it, most fixes of a real trace are
+#     further than the search radius from any generated road.
+# Ways use the format of db_wrapper.query_ways_within_radius with points in
+# EPSG:3857: {'osm_id', 'points', 'oneway'}.
+#
+# synthetic_network_around(observations) installs a network around a trace
+# as the road index and node table, like road_index.prefetched_corridor.
+# Generated way ids start at 1 for every network, so the way geometry cache
+# is cleared when a network is installed or removed.
+
+GRID_SPACING = 150.0           # meters between parallel streets
+ARTERIALS_PER_KM = 0.5         # curved arterials per km of box width and height
+ARTERIAL_VERTEX_SPACING = 25.0
+ARTERIAL_AMPLITUDE = 300.0     # meters
+ARTERIAL_WAVELENGTH = 2000.0   # meters
+ONEWAY_EVERY = 4
+TRACE_VERTEX_SPACING = 30.0
+TRACE_WAY_VERTICES = 20
+MARGIN = 500.0                 # meters of network around a trace
+
+def grid_ways(bounds, spacing=GRID_SPACING, first_id=1):
+    """Streets along the x and y axes every 'spacing' meters."""
+    min_x, min_y, max_x, max_y = bounds
+    xs = np.arange(min_x, max_x + spacing, spacing)
+    ys = np.arange(min_y, max_y + spacing, spacing)
+    ways = []
+    for i, x in enumerate(xs):
+        ways.append({'osm_id': first_id + len(ways), 'oneway': i % ONEWAY_EVERY == ONEWAY_EVERY - 1,
+                     'points': np.column_stack((np.full(len(ys), x), ys))})
+    for i, y in enumerate(ys):
+        ways.append({'osm_id': first_id + len(ways), 'oneway': i % ONEWAY_EVERY == ONEWAY_EVERY - 1,
+                     'points': np.column_stack((xs, np.full(len(xs), y)))})
+    return ways
+
+def arterial_ways(bounds, count, rng, first_id=1):
+    """'count' sinusoidal roads, alternately crossing the box along x and along y."""
+    min_x, min_y, max_x, max_y = bounds
+    ways = []
+    for i in range(count):
+        along_x = i % 2 == 0
+        lo, hi = (min_x, max_x) if along_x else (min_y, max_y)
+        t = np.arange(lo, hi + ARTERIAL_VERTEX_SPACING, ARTERIAL_VERTEX_SPACING)
+        offset = rng.uniform(min_y, max_y) if along_x else rng.uniform(min_x, max_x)
+        amplitude = rng.uniform(0.5, 1.0) * ARTERIAL_AMPLITUDE
+        wavelength = rng.uniform(0.5, 1.5) * ARTERIAL_WAVELENGTH
+        wave = offset + amplitude * np.sin(2 * np.pi * t / wavelength + rng.uniform(0, 2 * np.pi))
+        points = np.column_stack((t, wave)) if along_x else np.column_stack((wave, t))
+        ways.append({'osm_id': first_id + i, 'oneway': False, 'points': points})
+    return ways
+
+def synthetic_network(bounds, grid_spacing=GRID_SPACING, arterials_per_km=ARTERIALS_PER_KM, seed=0):
+    """Grid plus arterials covering 'bounds' = (min_x, min_y, max_x, max_y) in EPSG:3857."""
+    rng = np.random.default_rng(seed)
+    ways = grid_ways(bounds, grid_spacing) if grid_spacing else []
+    min_x, min_y, max_x, max_y = bounds
+    count = int(round(arterials_per_km * ((max_x - min_x) + (max_y - min_y)) / 1000.0))
+    return ways + arterial_ways(bounds, count, rng, first_id=len(ways) + 1)
+
+def trace_ways(observations, first_id=1):
+    """Two-way roads through the fixes of a trace."""
+    lat = np.array([o[0] for o in observations], dtype=np.float64)
+    lon = np.array([o[1] for o in observations], dtype=np.float64)
+    x, y = lonlat_to_mercator(lon, lat)
+    points = [(x[0], y[0])]
+    for p in zip(x[1:], y[1:]):
+        if np.hypot(p[0] - points[-1][0], p[1] - points[-1][1]) >= TRACE_VERTEX_SPACING:
+            points.append(p)
+    points = np.array(points, dtype=np.float64)
+    ways = []
+    # consecutive ways share their end vertex
+    for start in range(0, max(len(points) - 1, 1), TRACE_WAY_VERTICES - 1):
+        chunk = points[start:start + TRACE_WAY_VERTICES]
+        ways.append({'osm_id': first_id + len(ways), 'oneway': False, 'points': chunk})
+    return ways
+
+def trace_bounds(observations, margin=MARGIN):
+    lat = np.array([o[0] for o in observations], dtype=np.float64)
+    lon = np.array([o[1] for o in observations], dtype=np.float64)
+    x, y = lonlat_to_mercator(lon, lat)
+    return float(x.min() - margin), float(y.min() - margin), float(x.max() + margin), float(y.max() + margin)
+
+def network_node_table(ways):
+    """NodeTable for generated ways; the node ids are the endpoint ids of segment_store."""
+    way_ids = np.concatenate([np.full(len(w['points']), w['osm_id']) for w in ways])
+    indices = np.concatenate([np.arange(len(w['points'])) for w in ways])
+    points = np.concatenate([np.asarray(w['points'], dtype=np.float64) for w in ways])
+    lon, lat = mercator_to_lonlat(points[:, 0], points[:, 1])
+    return NodeTable(way_ids, indices, endpoint_node_ids(points), np.column_stack((lon, lat)))
+
+# Serve all road network lookups inside the block from a generated network
+# around 'observations'. Yields (index, ways). With 'follow_trace', the
+# network includes roads along the trace itself (see trace_ways).
+@contextmanager
+def synthetic_network_around(observations, margin=MARGIN, follow_trace=True, **network_kwargs):
+    import db_wrapper
+    import node_table
+    from geometry_cache import WAY_CACHE
+    ways = synthetic_network(trace_bounds(observations, margin), **network_kwargs)
+    if follow_trace:
+        ways += trace_ways(observations, first_id=len(ways) + 1)
+    index = RoadIndex.from_ways(ways)
+    WAY_CACHE.clear()
+    previous_index = db_wrapper.set_road_index(index)
+    previous_table = node_table.set_node_table(network_node_table(ways))
+    try:
+        yield index, ways
+    finally:
+        db_wrapper.set_road_index(previous_index)
+        node_table.set_node_table(previous_table)
+        WAY_CACHE.clear()
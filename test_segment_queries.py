@@ -0,0 +1,92 @@
+import sqlite3
+
+import numpy as np
+import pytest
+import shapely
+
+import db_wrapper
+from ingest_osm import ingest
+from road_index import RoadIndex
+
+# A long east-west road (many segments, most of them far from any one fix),
+# a north-south road crossing it and a short road off to the side
+WAYS = {
+    1: [(-122.200 + 0.001 * i, 37.450) for i in range(40)],
+    2: [(-122.180, 37.440 + 0.0015 * i) for i in range(15)],
+    3: [(-122.170, 37.455), (-122.168, 37.457), (-122.165, 37.456)],
+}
+FIXES = [(37.4502, -122.1853), (37.4499, -122.1801), (37.4551, -122.1702), (37.4700, -122.1900)]
+
+
+def _write_osm(path):
+    node_ids, nodes, ways = {}, [], []
+    for osm_id, points in WAYS.items():
+        refs = []
+        for lon, lat in points:
+            if (lon, lat) not in node_ids:
+                node_ids[lon, lat] = len(node_ids) + 1
+                nodes.append(f'  <node id="{node_ids[lon, lat]}" lon="{lon!r}" lat="{lat!r}"/>')
+            refs.append(f'    <nd ref="{node_ids[lon, lat]}"/>')
+        ways.append(f'  <way id="{osm_id}">\n' + '\n'.join(refs) +
+                    '\n    <tag k="highway" v="residential"/>\n  </way>')
+    path.write_text('<osm version="0.6">\n' + '\n'.join(nodes + ways) + '\n</osm>\n')
+
+
+def _write_lines_table(path):
+    # The 'lines' layout of create_index.py. Geometry is stored as WKB, so the
+    # AsBinary registered below stands in for SpatiaLite's.
+    connection = sqlite3.connect(path)
+    connection.execute(f"CREATE TABLE {db_wrapper.LINE_TABLE} (osm_id INTEGER, oneway TEXT, geometry BLOB)")
+    connection.execute(f"CREATE VIRTUAL TABLE rtree_{db_wrapper.LINE_TABLE}_geometry "
+                       f"USING rtree(id, minX, maxX, minY, maxY)")
+    for rowid, (osm_id, points) in enumerate(WAYS.items(), 1):
+        lonlat = np.array(points)
+        connection.execute(f"INSERT INTO {db_wrapper.LINE_TABLE} (ROWID, osm_id, oneway, geometry) VALUES (?, ?, ?, ?)",
+                           (rowid, osm_id, 'no', shapely.to_wkb(shapely.LineString(lonlat))))
+        connection.execute(f"INSERT INTO rtree_{db_wrapper.LINE_TABLE}_geometry VALUES (?, ?, ?, ?, ?)",
+                           (rowid, lonlat[:, 0].min(), lonlat[:, 0].max(), lonlat[:, 1].min(), lonlat[:, 1].max()))
+    connection.commit()
+    connection.close()
+
+
+@pytest.fixture
+def backends(tmp_path, monkeypatch):
+    osm_file, ingested, legacy = tmp_path / 'roads.osm', tmp_path / 'ingested.sqlite', tmp_path / 'legacy.sqlite'
+    _write_osm(osm_file)
+    ingest(str(osm_file), str(ingested))
+    _write_lines_table(legacy)
+    pools = {'legacy': db_wrapper.ConnectionPool(str(legacy), on_connect=lambda c: c.create_function('AsBinary', 1, bytes)),
+             'ingested': db_wrapper.ConnectionPool(str(ingested), on_connect=None)}
+    index = RoadIndex.from_ingested(str(ingested))
+    monkeypatch.setattr(db_wrapper, '_road_index', None)
+
+    def query(backend, lat, lon, radius):
+        db_wrapper.WAY_CACHE.clear()
+        if backend == 'index':
+            db_wrapper.set_road_index(index)
+        else:
+            db_wrapper.set_road_index(None)
+            monkeypatch.setattr(db_wrapper, 'pool', pools[backend])
+            monkeypatch.setattr(db_wrapper, '_has_segment_tables', None)
+        _, packed = db_wrapper.query_segments_within_radius(lat, lon, radius)
+        if packed is None:
+            return set()
+        return set(zip(packed['way_ids'].tolist(), packed['index_in_way'].tolist()))
+
+    yield query
+    for pool in pools.values():
+        pool.close()
+
+
+@pytest.mark.parametrize('radius', [30, 50, 200])
+@pytest.mark.parametrize('lat, lon', FIXES)
+def test_backends_return_the_same_segments(backends, lat, lon, radius):
+    legacy = backends('legacy', lat, lon, radius)
+    assert legacy == backends('ingested', lat, lon, radius)
+    assert legacy == backends('index', lat, lon, radius)
+
+
+def test_long_way_contributes_only_nearby_segments(backends):
+    segments = backends('legacy', 37.4502, -122.1853, 50)
+    long_way = {index for way_id, index in segments if way_id == 1}
+    assert long_way and len(long_way) <= 2
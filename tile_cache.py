@@ -0,0 +1,205 @@
+# Exports the road network as a directory of memory-mapped Web-Mercator tiles.
+# Command line arguments: output directory, optional path to database, optional tile size in meters
+#
+# The database is read once: a database written by ingest_osm.py with plain
+# sqlite3 (RoadIndex.from_ingested), otherwise the 'lines' table through
+# SpatiaLite (RoadIndex.from_database). Workers then open the tiles with
+#   db_wrapper.set_road_index(TileCache.load(directory))
+# which takes milliseconds and needs neither SpatiaLite nor the database;
+# only the node ids of the final path are still read from the way_nodes table
+# (plain sqlite3, see node_table.py).
+
+import json
+import logging
+import math
+import os
+import sys
+from collections import OrderedDict
+import numpy as np
+
+from geometry_cache import segment_angles
+from road_index import RoadIndex, lonlat_to_mercator, _cell_keys
+
+# SUMMARY
+#--------------------
+# The network is cut into square tiles of 'tile_size' meters in EPSG:3857.
+# Every segment is stored in each tile its bounding box overlaps, so a query
+# only reads the tiles around the fix. Storage layout, one .npy file per
+# array (rows grouped by tile):
+#   endpoints     (S,2,2) segment endpoints
+#   angles        (S,)    heading of the segment, as geometry_cache.segment_angles
+#   way_ids       (S,)    OSM id of the way
+#   index_in_way  (S,)    index of the segment in its way
+#   oneway        (S,)    bool
+#   segment_ids   (S,)    unique per segment, to drop the copies of a
+#                         segment found in several tiles
+#   tile_keys     (T,)    sorted keys of the non-empty tiles
+#   tile_offsets  (T+1,)  rows of tile tile_keys[t] are tile_offsets[t]:tile_offsets[t+1]
+# plus meta.json with the tile size.
+#
+# TileCache.load maps the files read-only, so a tile is only paged in from
+# disk when a fix first falls into it, and all processes share the pages. The
+# bounding boxes of a paged in tile are kept for the next queries, for at most
+# MAX_TILES tiles (least recently used are dropped).
+#
+# A TileCache answers query_segments_within_radius like a RoadIndex, which is
+# all the emission step needs. Tiles only hold segments, not whole ways:
+# query_ways_within_radius and routed transitions (road_graph.RoadGraph) still
+# need a RoadIndex.
+
+TILE_SIZE = 1000.0  # meters
+MAX_TILES = 256
+TILE_ARRAYS = ('endpoints', 'angles', 'way_ids', 'index_in_way', 'oneway', 'segment_ids',
+               'tile_keys', 'tile_offsets')
+PACKED_FIELDS = ('endpoints', 'angles', 'way_ids', 'index_in_way', 'oneway')
+
+logger = logging.getLogger(__name__)
+
+def export_tiles(index, directory, tile_size=TILE_SIZE):
+    """Write the segments of a RoadIndex as tiles to 'directory'. Returns the number of tiles."""
+    seg_start, seg_way = np.asarray(index.seg_start), np.asarray(index.seg_way)
+    vertices = np.asarray(index.vertices)
+    endpoints = np.stack((vertices[seg_start], vertices[seg_start + 1]), axis=1)
+    seg_min, seg_max = endpoints.min(axis=1), endpoints.max(axis=1)
+
+    # Every (segment, tile) pair covered by the segment's bbox, as in RoadIndex._build_grid
+    ix0 = np.floor(seg_min[:, 0] / tile_size).astype(np.int64)
+    iy0 = np.floor(seg_min[:, 1] / tile_size).astype(np.int64)
+    nx = np.floor(seg_max[:, 0] / tile_size).astype(np.int64) - ix0 + 1
+    ny = np.floor(seg_max[:, 1] / tile_size).astype(np.int64) - iy0 + 1
+    counts = nx * ny
+    rows = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = _cell_keys(ix0[rows] + local // ny[rows], iy0[rows] + local % ny[rows])
+    order = np.argsort(keys, kind='stable')
+    keys, rows = keys[order], rows[order]
+    tile_keys, starts = np.unique(keys, return_index=True)
+
+    arrays = {
+        'endpoints': endpoints[rows],
+        'angles': segment_angles(endpoints)[rows],
+        'way_ids': np.asarray(index.way_ids)[seg_way[rows]],
+        'index_in_way': (seg_start - np.asarray(index.way_offsets)[seg_way])[rows].astype(np.int32),
+        'oneway': np.asarray(index.oneway)[seg_way[rows]],
+        'segment_ids': rows.astype(np.int64),
+        'tile_keys': tile_keys,
+        'tile_offsets': np.append(starts, len(keys)).astype(np.int64),
+    }
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in TILE_ARRAYS:
+        np.save(os.path.join(directory, name + '.npy'), arrays[name])
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump({'tile_size': tile_size, 'segments': len(seg_start), 'tiles': len(tile_keys)}, f)
+    return len(tile_keys)
+
+
+class TileCache(object):
+
+    def __init__(self, arrays, tile_size, max_tiles=MAX_TILES):
+        for name in TILE_ARRAYS:
+            setattr(self, name, arrays[name])
+        self.tile_size = float(tile_size)
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()  # tile row -> (first row, seg_min, seg_max)
+
+    @classmethod
+    def load(cls, directory, mmap=True, max_tiles=MAX_TILES):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in TILE_ARRAYS}
+        # The directory is small and searched on every query: keep it in memory
+        arrays['tile_keys'] = np.array(arrays['tile_keys'])
+        arrays['tile_offsets'] = np.array(arrays['tile_offsets'])
+        return cls(arrays, meta['tile_size'], max_tiles)
+
+    def __len__(self):
+        return len(self.tile_keys)
+
+    # Bounding boxes of the segments of tile t, paged in on first use
+    def _tile(self, t):
+        tile = self._tiles.get(t)
+        if tile is not None:
+            self._tiles.move_to_end(t)
+            return tile
+        first, end = int(self.tile_offsets[t]), int(self.tile_offsets[t + 1])
+        endpoints = np.asarray(self.endpoints[first:end])
+        tile = (first, endpoints.min(axis=1), endpoints.max(axis=1))
+        self._tiles[t] = tile
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    # Rows of the segments whose bounding boxes intersect the query box
+    def _rows_in_box(self, min_x, min_y, max_x, max_y):
+        ts = self.tile_size
+        ix = np.arange(math.floor(min_x / ts), math.floor(max_x / ts) + 1)
+        iy = np.arange(math.floor(min_y / ts), math.floor(max_y / ts) + 1)
+        keys = _cell_keys(np.repeat(ix, len(iy)), np.tile(iy, len(ix)))
+        pos = np.searchsorted(self.tile_keys, keys)
+        found = pos < len(self.tile_keys)
+        pos, keys = pos[found], keys[found]
+        pos = pos[self.tile_keys[pos] == keys]
+        in_tiles = []
+        for t in pos.tolist():
+            first, seg_min, seg_max = self._tile(t)
+            mask = ((seg_min[:, 0] <= max_x) & (seg_max[:, 0] >= min_x) &
+                    (seg_min[:, 1] <= max_y) & (seg_max[:, 1] >= min_y))
+            in_tiles.append(first + np.nonzero(mask)[0])
+        if not in_tiles:
+            return np.empty(0, dtype=np.int64)
+        if len(in_tiles) == 1:
+            return in_tiles[0]
+        # A segment crossing a tile border is stored in every tile it touches
+        rows = np.concatenate(in_tiles)
+        _, unique = np.unique(self.segment_ids[rows], return_index=True)
+        return rows[np.sort(unique)]
+
+    def query_segments_within_radius(self, lat, lon, radius):
+        """
+        Same contract as db_wrapper.query_segments_within_radius: returns the
+        point in EPSG:3857 and the segments whose boxes intersect the search
+        box, packed as in segment_store.pack_way_segments, or (None, None).
+        """
+        merc_x, merc_y = lonlat_to_mercator(lon, lat)
+        merc_x, merc_y = float(merc_x), float(merc_y)
+        rows = self._rows_in_box(merc_x - radius, merc_y - radius, merc_x + radius, merc_y + radius)
+        if len(rows) == 0:
+            return None, None
+        return (merc_x, merc_y), {field: getattr(self, field)[rows] for field in PACKED_FIELDS}
+
+    def query_ways_within_radius(self, lat, lon, radius):
+        raise Exception('A TileCache only stores segments: use a RoadIndex for way queries')
+
+def main(argv):
+    if len(argv) not in (2, 3, 4):
+        raise Exception('args: output directory, [path to database], [tile size in meters]')
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    directory = argv[1]
+    tile_size = float(argv[3]) if len(argv) == 4 else TILE_SIZE
+    if len(argv) >= 3:
+        db_file = argv[2]
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        db_file = os.path.join(script_dir, 'socal_roads.sqlite')
+
+    from ingest_osm import SEGMENT_TABLE
+    from node_table import connect
+    connection = connect(db_file)
+    try:
+        ingested = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?",
+                                      (SEGMENT_TABLE,)).fetchone()[0] > 0
+    finally:
+        connection.close()
+    if ingested:
+        index = RoadIndex.from_ingested(db_file)
+    else:
+        import db_wrapper
+        index = RoadIndex.from_database(db_wrapper.ConnectionPool(db_file, size=1))
+    logger.info(f"Loaded {len(index.seg_start)} segments of {len(index)} ways")
+    tiles = export_tiles(index, directory, tile_size)
+    logger.info(f"Wrote {tiles} tiles of {tile_size:.0f} m to {directory}")
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,5 +1,6 @@
-import math
+import numpy as np
 import utils
+from segment_store import CandidateSet
 # --- MODIFIED: Import weights from our new config file ---
 from model_weights import TRANSITION_WEIGHTS
 
@@ -7,58 +8,60 @@ from model_weights import TRANSITION_WEIGHTS
 # W_DIST = 0.2
 # W_BT = 0.8
 
+# All scores are computed as (len(segments1), len(segments2)) NumPy matrices:
+# the projections of the observations are computed once per segment and the
+# pairwise comparisons are done by broadcasting. Segments are CandidateSets
+# (see segment_store.py); lists of segment dicts are converted.
+
 # Bactrack score assigns a penalty on going back through where you came from.
 # If the previous segment's start is in the next segment's endpoints, i.e.
 # you're backtracking through the start point to get to the next one, return 0.
 # Else return 1
 def _compute_backtrack_scores(segments1, segments2):
-    scores = [[] for _ in range(len(segments1))]
-    for i, segment1 in enumerate(segments1):
-        for segment2 in segments2:
-            if segment1['direction'] is None or segment1['endpoints'] == segment2['endpoints']:
-                scores[i].append(1.0)
-                continue
-            elif segment1['direction'] == 1:
-                segment1_start = segment1['endpoints'][0]
-                segment1_end = segment1['endpoints'][1]
-            elif segment1['direction'] == -1:
-                segment1_end = segment1['endpoints'][0]
-                segment1_start = segment1['endpoints'][1]
-
-            if segment1_start in segment2['endpoints']:
-                scores[i].append(0.0)
-            else:
-                scores[i].append(1.0)
-    return scores
+    segments1 = CandidateSet.from_segments(segments1)
+    segments2 = CandidateSet.from_segments(segments2)
+    ids1, ids2 = segments1.node_ids, segments2.node_ids
+    directions = segments1.directions
+    starts = np.where(directions == -1, ids1[:, 1], ids1[:, 0])[:, None]
+    same_segment = (ids1[:, None, 0] == ids2[None, :, 0]) & (ids1[:, None, 1] == ids2[None, :, 1])
+    backtracking = (starts == ids2[None, :, 0]) | (starts == ids2[None, :, 1])
+    backtracking &= (directions[:, None] != 0) & ~same_segment
+    return np.where(backtracking, 0.0, 1.0)
 
 def _compute_distance_scores(obs1, obs2, segments1, segments2):
-    scores = [[] for _ in range(len(segments1))]
+    segments1 = CandidateSet.from_segments(segments1)
+    segments2 = CandidateSet.from_segments(segments2)
     base_dist = utils.euclidean_dist(obs1, obs2)
-    for i, segment1 in enumerate(segments1):
-        projection1 = utils.get_projection(segment1['endpoints'], obs1)
-        for segment2 in segments2:
-            projection2 = utils.get_projection(segment2['endpoints'], obs2)
-            dist = utils.euclidean_dist(projection1, projection2)
-            dist_diff = abs(dist - base_dist)
-            scores[i].append(1.0/(1.0+dist_diff))
-    return scores
+    projections1 = utils.get_projections(segments1.endpoints, obs1)
+    projections2 = utils.get_projections(segments2.endpoints, obs2)
+    delta = projections1[:, None, :] - projections2[None, :, :]
+    dist = np.hypot(delta[..., 0], delta[..., 1])
+    return 1.0/(1.0 + np.abs(dist - base_dist))
+
+# Same score with the distance driven along the road network (see road_graph.py)
+# instead of the straight line between the projections. Pairs without a route
+# within the search bound score 0.
+def _compute_routed_distance_scores(obs1, obs2, segments1, segments2, graph):
+    base_dist = utils.euclidean_dist(obs1, obs2)
+    dist = graph.route_distances(obs1, obs2, segments1, segments2)
+    return 1.0/(1.0 + np.abs(dist - base_dist))
 
 # --- MODIFIED: This function now uses the imported weights ---
-def compute_transition_probabilities(obs1, obs2, segments1, segments2):
+# With a RoadGraph, the distance score uses routed distances.
+def compute_transition_probabilities(obs1, obs2, segments1, segments2, graph=None):
     obs1 = obs1[:2]
     obs2 = obs2[:2]
-    dist_scores = _compute_distance_scores(obs1, obs2, segments1, segments2)
+    if graph is None:
+        dist_scores = _compute_distance_scores(obs1, obs2, segments1, segments2)
+    else:
+        dist_scores = _compute_routed_distance_scores(obs1, obs2, segments1, segments2, graph)
     backtrack_scores = _compute_backtrack_scores(segments1, segments2)
     
     # Get weights from our model_weights file
     w_dist_diff = TRANSITION_WEIGHTS['distance_diff']
     w_backtrack = TRANSITION_WEIGHTS['backtrack']
 
-    scores = [[] for _ in range(len(dist_scores))]
-    for i in range(len(dist_scores)):
-        for j in range(len(dist_scores[0])):
-            scores[i].append(w_dist_diff * dist_scores[i][j] + w_backtrack * backtrack_scores[i][j])
-    return scores
+    return w_dist_diff * dist_scores + w_backtrack * backtrack_scores
 
 # --- MODIFIED: This function (used for training) also uses the new weights ---
 def compute_transition_probabilities_training(obs1, obs2, segments1, segments2, t, TRANSITION_PROBS):
@@ -71,15 +74,13 @@ def compute_transition_probabilities_training(obs1, obs2, segments1, segments2,
     w_dist_diff = TRANSITION_WEIGHTS['distance_diff']
     w_backtrack = TRANSITION_WEIGHTS['backtrack']
 
-    scores = [[] for _ in range(len(dist_scores))]
     TRANSITION_PROBS[t] = {}
-    for i in range(len(dist_scores)):
-        for j in range(len(dist_scores[0])):
-            segment1_str = '{0},{1}'.format(segments1[i]['way_osm_id'], segments1[i]['index_in_way'])
-            segment2_str = '{0},{1}'.format(segments2[j]['way_osm_id'], segments2[j]['index_in_way'])
-            if segment1_str in TRANSITION_PROBS[t]:
-                TRANSITION_PROBS[t][segment1_str][segment2_str] = [dist_scores[i][j], backtrack_scores[i][j], 0]
-            else:
-                TRANSITION_PROBS[t][segment1_str] = {segment2_str: [dist_scores[i][j], backtrack_scores[i][j], 0]}
-            scores[i].append(w_dist_diff * dist_scores[i][j] + w_backtrack * backtrack_scores[i][j])
-    return scores
+    segments1 = CandidateSet.from_segments(segments1)
+    segments2 = CandidateSet.from_segments(segments2)
+    segment1_strs = ['{0},{1}'.format(w, i) for w, i in zip(segments1.way_ids.tolist(), segments1.index_in_way.tolist())]
+    segment2_strs = ['{0},{1}'.format(w, i) for w, i in zip(segments2.way_ids.tolist(), segments2.index_in_way.tolist())]
+    for i, segment1_str in enumerate(segment1_strs):
+        features = TRANSITION_PROBS[t].setdefault(segment1_str, {})
+        for j, segment2_str in enumerate(segment2_strs):
+            features[segment2_str] = [dist_scores[i, j], backtrack_scores[i, j], 0]
+    return w_dist_diff * dist_scores + w_backtrack * backtrack_scores
@@ -1,7 +1,6 @@
-import re
 import math
 import numpy as np
-from db_wrapper import get_node_id, get_node_gps_point
+import node_table
 
 # Euclidean distance between two points
 def euclidean_dist(a, b):
@@ -47,39 +46,41 @@ def get_projection(endpoints, point):
     projection = endpoints[0] + projection_magnitude*u
     return projection
 
+# Vectorized get_projection: projects 'point' onto each of the K segments in
+# endpoints, an array of shape (K,2,2). Returns the projections, shape (K,2).
+# Zero-length segments project onto their first endpoint.
+def get_projections(endpoints, point):
+    endpoints = np.asarray(endpoints, dtype=np.float64)
+    fractions = get_projection_fractions(endpoints, point)
+    return endpoints[:, 0] + fractions[:, None] * (endpoints[:, 1] - endpoints[:, 0])
+
+# Position of the projection along each segment: 0 at endpoints[0], 1 at endpoints[1]
+def get_projection_fractions(endpoints, point):
+    endpoints = np.asarray(endpoints, dtype=np.float64)
+    p = np.asarray(point, dtype=np.float64)
+    start = endpoints[:, 0]
+    u = endpoints[:, 1] - start
+    v = p - start
+    uu = np.einsum('ij,ij->i', u, u)
+    uv = np.einsum('ij,ij->i', u, v)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        projection_magnitude = np.where(uu > 0, uv / uu, 0.0)
+    return np.clip(projection_magnitude, 0.0, 1.0)
+
+# Vectorized point_to_lineseg_dist over K segments
+def point_to_linesegs_dist(endpoints, point):
+    projections = get_projections(endpoints, point)
+    return np.hypot(projections[:, 0] - point[0], projections[:, 1] - point[1])
+
+# (lon, lat) of the start and end node of every matched segment, in the
+# direction of travel. Resolved in bulk from the node table (node_table.py).
 def get_node_gps_points(matches):
-    node_gps = []
-    for i, match in enumerate(matches):
-        if match['way_osm_id'] is None:
-            node_ids.append(None)
-            continue
-        # Don't query the same point twice
-        if i == 0 or match['way_osm_id'] != matches[i-1]['way_osm_id'] or match['index_in_way'] != matches[i-1]['index_in_way']:
-            start_node = get_node_gps_point(match['way_osm_id'], match['index_in_way'])
-            end_node = get_node_gps_point(match['way_osm_id'], match['index_in_way'] + 1)
-        if match['direction'] == -1:
-            node_gps.append((end_node, start_node))
-        else:
-            node_gps.append((start_node, end_node))
-    return node_gps
+    return node_table.table_for_path(matches).resolve_path_gps(matches)
 
+# OSM ids of the start and end node of every matched segment, in the
+# direction of travel. Resolved in bulk from the node table (node_table.py).
 def get_node_ids(matches):
-    node_ids = []
-    for i, match in enumerate(matches):
-        if match['way_osm_id'] is None:
-            node_ids.append(None)
-            continue
-        # Don't query the same point twice
-        if i == 0 or match['way_osm_id'] != matches[i-1]['way_osm_id'] or match['index_in_way'] != matches[i-1]['index_in_way']:
-            start_node = get_node_id(match['way_osm_id'], match['index_in_way'])
-            start_node = re.findall(r'\d+', str(start_node))[0]
-            end_node = get_node_id(match['way_osm_id'], match['index_in_way']+1)
-            end_node = re.findall(r'\d+', str(end_node))[0]
-        if match['direction'] == -1:
-            node_ids.append((end_node, start_node))
-        else:
-            node_ids.append((start_node, end_node))
-    return node_ids
+    return node_table.table_for_path(matches).resolve_path(matches)
  
 def write_to_file(node_ids, filename):
     with open(filename, 'w') as f:
@@ -105,3 +106,16 @@ def calculate_direction(previous_segment, segment):
     else:
         return None
 
+# Array version of calculate_direction for CandidateSets (see segment_store.py):
+# the direction of every candidate in 'segments' given the index of its
+# previous candidate in 'previous_segments' (-1 if none). 0 means unknown.
+def calculate_directions(previous_segments, segments, previous_indices):
+    has_previous = previous_indices >= 0
+    prev_ids = previous_segments.node_ids[np.where(has_previous, previous_indices, 0)]
+    prev_directions = previous_segments.directions[np.where(has_previous, previous_indices, 0)]
+    ids = segments.node_ids
+    same = (ids[:, 0] == prev_ids[:, 0]) & (ids[:, 1] == prev_ids[:, 1])
+    start_connected = (ids[:, 0] == prev_ids[:, 0]) | (ids[:, 0] == prev_ids[:, 1])
+    end_connected = (ids[:, 1] == prev_ids[:, 0]) | (ids[:, 1] == prev_ids[:, 1])
+    directions = np.where(same, prev_directions, np.where(start_connected, 1, np.where(end_connected, -1, 0)))
+    return np.where(has_previous, directions, 0).astype(np.int8)
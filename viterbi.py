@@ -1,188 +1,299 @@
-import math
-import copy
+import logging
+import numpy as np
+import metrics
 import utils
-from emission_probability import compute_emission_probabilities
+import db_wrapper
+import AKF
+import MAD
+import preprocess
+from road_index import prefetched_corridor, lonlat_to_mercator, mercator_to_lonlat
+from road_graph import RoadGraph, ROUTE_BOUND_SLACK
+from emission_probability import compute_emission_probabilities, GPS_SIGMA
 from transition_probability import compute_transition_probabilities
 
 RADIUS = 20
 N = 10
-WINDOW = 50  # currently unused; consider using as beam/window size
+WINDOW = 50  # maximum lag (in DP steps) of the online matcher, see online_viterbi.py
+# Fixes with fewer than NEAREST_K segments within the radius are searched again
+# at twice the radius, and so on up to MAX_DISTANCE_FACTOR * radius, in one
+# lookup (db_wrapper.query_nearest_segments)
+NEAREST_K = 1
+MAX_DISTANCE_FACTOR = 2
 
 NEG_INF = float('-inf')
 
+# Opt-in beam pruning (viterbi(..., prune=True)). Emission and transition
+# scores are weighted sums in [0, 1], so log gaps between states are small.
+LOG_BEAM = 1.5        # drop states whose log-probability is more than this below the step's best
+EMISSION_BEAM = 0.25  # candidates within this of the best log-emission count as plausible
+MIN_N = 2            # adaptive candidate count never goes below this
+MAX_N_FACTOR = 2     # ... nor above this times the starting n
+
+logger = logging.getLogger(__name__)
+
 def _to_log_probs(probs):
-    """Convert list of probabilities to log-probabilities, safe for zeros."""
-    logs = []
-    for p in probs:
-        if p is None:
-            logs.append(NEG_INF)
-        else:
-            # guard tiny values
-            if p <= 0.0:
-                logs.append(NEG_INF)
-            else:
-                logs.append(math.log(p))
+    """Convert probabilities (a list or an array) to log-probabilities, safe for zeros."""
+    if not isinstance(probs, np.ndarray):
+        probs = np.array([0.0 if p is None else p for p in probs], dtype=np.float64)
+    logs = np.full(probs.shape, NEG_INF)
+    positive = probs > 0.0
+    logs[positive] = np.log(probs[positive])
     return logs
 
+def _viterbi_step(prev_log_probs, log_transitions, log_emissions):
+    """
+    One DP step over all candidate pairs at once:
+        scores[j, i] = prev_log_probs[j] + log_transitions[j, i] + log_emissions[i]
+    Returns the best log-probability of every current candidate i and the index
+    of its best previous candidate j (-1 if no previous candidate can reach it).
+    Ties go to the lowest j.
+    """
+    scores = prev_log_probs[:, None] + log_transitions + log_emissions[None, :]
+    backpointers = np.argmax(scores, axis=0)
+    log_probs = scores[backpointers, np.arange(scores.shape[1])]
+    backpointers[log_probs == NEG_INF] = -1
+    return log_probs, backpointers
+
+def _set_directions(prev_segments, segments, backpointers):
+    """Set the traversal direction of every candidate from its best previous candidate."""
+    segments.directions = utils.calculate_directions(prev_segments, segments, backpointers)
+
+def _prune(segments, log_probs, backpointers, beam):
+    """Drop the states more than 'beam' below the best one. Returns the kept states and the number pruned."""
+    keep = log_probs >= np.max(log_probs) - beam
+    if np.all(keep):
+        return segments, log_probs, backpointers, 0
+    kept = np.nonzero(keep)[0]
+    return segments.take(kept), log_probs[kept], backpointers[kept], len(segments) - len(kept)
+
+def _adapt_n(log_emissions, n, min_n, max_n, emission_beam):
+    """
+    Candidate count for the next observation from the spread of the current
+    emissions: twice the number of plausible candidates, or twice the current
+    count if all of them were plausible.
+    """
+    plausible = int(np.sum(log_emissions >= np.max(log_emissions) - emission_beam))
+    if plausible >= len(log_emissions):
+        return min(max_n, 2 * n)
+    return max(min_n, min(max_n, 2 * plausible))
+
+def _prune_step(step, beam, next_n, prune_stats):
+    segments, log_probs, backpointers, t_obs_index = step
+    states = len(segments)
+    segments, log_probs, backpointers, pruned = _prune(segments, log_probs, backpointers, beam)
+    prune_stats.append({'observation_index': t_obs_index, 'n': next_n, 'states': states, 'pruned': pruned})
+    return segments, log_probs, backpointers, t_obs_index
+
+def _backtrack(steps):
+    """
+    Walk the backpointers from the best final candidate. Each step is a tuple
+    (segments, log_probs, backpointers, observation_index). Only the segments
+    on the final path are turned into dicts, with 'previous' set to their
+    backpointer and 'observation_index' to the observation they match.
+    """
+    segments, log_probs, _, _ = steps[-1]
+    cur_idx = int(np.argmax(log_probs))
+    final_path = []
+    for segments, _, backpointers, t_obs_index in reversed(steps):
+        prev_idx = int(backpointers[cur_idx])
+        segment = segments.segment(cur_idx)
+        segment['previous'] = prev_idx if prev_idx >= 0 else None
+        segment['observation_index'] = t_obs_index
+        final_path.append(segment)
+        # If there is no previous candidate, we've reached the start — stop.
+        if prev_idx < 0:
+            break
+        cur_idx = prev_idx
+    return final_path[::-1]
+
+def _compute_candidates(obs, t_obs_index, radius, n, sigma=GPS_SIGMA, cache=None, max_distance=None, k=NEAREST_K):
+    """
+    Emission step for one observation. Where fewer than k segments are within
+    'radius', the search box is doubled up to 'max_distance' (by default
+    MAX_DISTANCE_FACTOR * radius) in the same lookup, and scored once.
+    """
+    metrics.count('observations')
+    if max_distance is None:
+        max_distance = MAX_DISTANCE_FACTOR * radius
+    segments, emission_probabilities, point = compute_emission_probabilities(obs, radius, n, sigma, cache,
+                                                                             max_distance, k)
+    if not segments:
+        logger.warning(f"No segments found for observation {t_obs_index + 1}. Skipping this observation.")
+        metrics.count('skipped')
+        return segments, emission_probabilities, point
+    metrics.observe('candidates', len(segments))
+    return segments, emission_probabilities, point
+
+def _transition_step(prev_point, point, prev_segments, prev_log_probs, segments, emission_probabilities, graph=None):
+    """
+    Transition and DP step from the previous candidates to 'segments'. Sets
+    their directions. With a RoadGraph, transitions use routed distances.
+    """
+    # transition matrix: shape (len(prev_segments), len(segments))
+    with metrics.timer('transition'):
+        transition_probs = compute_transition_probabilities(prev_point, point, prev_segments, segments, graph)
+        log_transitions = _to_log_probs(np.asarray(transition_probs, dtype=np.float64))
+    with metrics.timer('dp'):
+        log_probs, backpointers = _viterbi_step(prev_log_probs, log_transitions, _to_log_probs(emission_probabilities))
+        _set_directions(prev_segments, segments, backpointers)
+    return log_probs, backpointers
+
+def _update_sigma(sigma_estimator, step):
+    """Feed the distance of the step's best candidate, the current estimate of the match, to the estimator."""
+    segments, log_probs, _, _ = step
+    sigma_estimator.update(float(segments.distances[int(np.argmax(log_probs))]))
+
+def _smooth_observations(observations, alpha):
+    """Observations with Kalman smoothed positions (AKF.smooth, in meters); course and speed are kept."""
+    lat = np.array([o[0] for o in observations], dtype=np.float64)
+    lon = np.array([o[1] for o in observations], dtype=np.float64)
+    xy = AKF.smooth(np.column_stack(lonlat_to_mercator(lon, lat)), alpha, GPS_SIGMA**2)
+    lon, lat = mercator_to_lonlat(xy[:, 0], xy[:, 1])
+    return [(la, lo) + tuple(o[2:]) for la, lo, o in zip(lat.tolist(), lon.tolist(), observations)]
+
+def _expand_node_ids(node_ids, final_path, fix_index, n_kept):
+    """
+    One node id per original fix: the node id matched to the fix it was
+    collapsed into by preprocess.preprocess, None where that fix is unmatched.
+    """
+    kept_node_ids = [None] * n_kept
+    for node_id, segment in zip(node_ids, final_path):
+        kept_node_ids[segment['observation_index']] = node_id
+    return preprocess.expand(kept_node_ids, fix_index)
+
+def prefetch_buffer(**kwargs):
+    """
+    Distance around the fixes whose roads viterbi(**kwargs) can reach: the
+    nearest segment search, and detours when routing.
+    """
+    radius = kwargs.get('radius', RADIUS)
+    max_distance = kwargs.get('max_distance', MAX_DISTANCE_FACTOR * radius)
+    return max(radius, max_distance) + (ROUTE_BOUND_SLACK if kwargs.get('routed', False) else 0)
+
+def _road_graph():
+    """RoadGraph over the installed road index, for routed transitions."""
+    index = db_wrapper.get_road_index()
+    if index is None:
+        raise Exception('Routed transitions need a road index: use prefetch=True or db_wrapper.set_road_index()')
+    return RoadGraph(index)
+
 def viterbi(observations, **kwargs):
+    # Report to this metrics sink (see metrics.py) instead of the installed one
+    if kwargs.get('metrics') is not None:
+        with metrics.using(kwargs['metrics']):
+            return viterbi(observations, **dict(kwargs, metrics=None))
+
     radius = kwargs.get('radius', RADIUS)
     filename = kwargs.get('filename', None)
     window = kwargs.get('window', WINDOW)
     n = kwargs.get('n', N)
+    prune = kwargs.get('prune', False)
+    beam = kwargs.get('beam', LOG_BEAM)
+    emission_beam = kwargs.get('emission_beam', EMISSION_BEAM)
+    min_n = kwargs.get('min_n', MIN_N)
+    max_n = kwargs.get('max_n', MAX_N_FACTOR * n)
+    # Per DP step: {'observation_index', 'n', 'states', 'pruned'}
+    prune_stats = kwargs.get('prune_stats', [])
+    # Score transitions by the distance along the road network (needs a road index)
+    routed = kwargs.get('routed', False)
+    # Kalman smooth the positions before matching (see AKF.py)
+    smooth = kwargs.get('smooth', False)
+    smooth_alpha = kwargs.get('smooth_alpha', AKF.ALPHA)
+    # Estimate the GPS error of this trace while matching (MAD.OnlineMAD)
+    # instead of using the fixed GPS_SIGMA
+    sigma_estimator = MAD.OnlineMAD(GPS_SIGMA) if kwargs.get('adaptive_sigma', False) else None
+    # Collapse stationary fixes and optionally downsample before matching
+    # (preprocess.py): True, or a dict of preprocess.preprocess options. The
+    # result then has one row per original fix.
+    preprocess_options = kwargs.get('preprocess', False)
+    # Reuse the candidates of earlier fixes at the same place and course
+    # (emission_cache.EmissionCache); saving the cache is up to the caller
+    emission_cache = kwargs.get('emission_cache', None)
+    # Reach of the nearest segment search for fixes with fewer than
+    # 'nearest_k' segments within the radius
+    max_distance = kwargs.get('max_distance', MAX_DISTANCE_FACTOR * radius)
+    nearest_k = kwargs.get('nearest_k', NEAREST_K)
 
     if not observations:
-        print("No observations provided to viterbi().")
+        logger.error("No observations provided to viterbi().")
         return None
 
-    print(f'Running viterbi. Window size: {window}, Max states: {n}, Max radius: {radius}')
+    # Batch mode: fetch the road network around the whole trace up front
+    if kwargs.get('prefetch', False) and db_wrapper.get_road_index() is None:
+        with prefetched_corridor(observations, prefetch_buffer(**kwargs)):
+            return viterbi(observations, **dict(kwargs, prefetch=False))
+
+    graph = _road_graph() if routed else None
+    fix_index = None
+    if preprocess_options:
+        n_fixes = len(observations)
+        observations, fix_index = preprocess.preprocess(
+            observations, **(preprocess_options if isinstance(preprocess_options, dict) else {}))
+        logger.info(f"Preprocessing kept {len(observations)} of {n_fixes} fixes")
+    if smooth:
+        observations = _smooth_observations(observations, smooth_alpha)
+
+    logger.info(f'Running viterbi. Window size: {window}, Max states: {n}, Max radius: {radius}')
 
     # --- Initialize the first step ---
-    print("Processing first observation...")
-    segments, emission_probabilities, point = compute_emission_probabilities(observations[0], radius, n)
+    logger.debug("Processing first observation...")
+    metrics.count('observations')
+    segments, emission_probabilities, point = compute_emission_probabilities(observations[0], radius, n,
+                                                                             GPS_SIGMA, emission_cache,
+                                                                             max_distance, nearest_k)
 
     if not segments:
-        print("ERROR: Could not find any road segments for the starting GPS point. Aborting.")
+        logger.error("Could not find any road segments for the starting GPS point. Aborting.")
         return None
-
-    # prepare segments and set previous pointers to None
-    for seg in segments:
-        seg['previous'] = None
-        seg['direction'] = None
-
-    # tables: at index t we store candidate segments and log-probabilities
-    segments_table = [segments]
-    probabilities_table = [_to_log_probs(emission_probabilities)]
-
-    # Keep track of which original observation indices map to DP entries
-    dp_index_to_obs_index = [0]  # dp index 0 corresponds to observations[0]
+    metrics.observe('candidates', len(segments))
+    sigma = GPS_SIGMA
+
+    # One entry per DP step: (segments, log_probs, backpointers, observation_index).
+    # Skipped observations get no entry.
+    steps = [(segments, _to_log_probs(emission_probabilities), np.full(len(segments), -1), 0)]
+    if prune:
+        n = _adapt_n(steps[0][1], n, min_n, max_n, emission_beam)
+        steps[0] = _prune_step(steps[0], beam, n, prune_stats)
+    if sigma_estimator is not None:
+        _update_sigma(sigma_estimator, steps[0])
+        sigma = sigma_estimator.sigma()
 
     # --- Process rest of observations ---
     for t_obs_index, obs in enumerate(observations[1:], start=1):
-        print(f"Processing observation {t_obs_index + 1}/{len(observations)}...")
-
-        prev_point = point
-        segments, emission_probabilities, point = compute_emission_probabilities(obs, radius, n)
-
-        # if no segments found: try a single retry with larger radius (simple heuristic)
-        if not segments:
-            print(f"  WARNING: No segments for observation {t_obs_index + 1}. Retrying with larger radius...")
-            segments, emission_probabilities, point = compute_emission_probabilities(obs, radius * 2, n)
+        logger.debug(f"Processing observation {t_obs_index + 1}/{len(observations)}...")
 
+        prev_segments, prev_log_probs, _, _ = steps[-1]
+        segments, emission_probabilities, new_point = _compute_candidates(obs, t_obs_index, radius, n, sigma,
+                                                                        emission_cache, max_distance, nearest_k)
         if not segments:
-            # Mark this observation as skipped: do not append duplicate objects.
-            print(f"  WARNING: Still no segments found for observation {t_obs_index + 1}. Skipping this observation.")
-            # We do NOT append to segments_table/probabilities_table.
-            # Map this observation index to None so we know it's skipped.
-            dp_index_to_obs_index.append(None)
             continue
 
-        # compute transition probabilities matrix: shape (len(prev_segments), len(segments))
-        transition_probs = compute_transition_probabilities(prev_point, point, segments_table[-1], segments)
-        # convert emission and transition to logs
-        log_emissions = _to_log_probs(emission_probabilities)
-
-        prev_log_probs = probabilities_table[-1]
-        num_prev = len(prev_log_probs)
-        num_curr = len(log_emissions)
-
-        # initialize current log-prob list and backpointers
-        current_log_probs = [NEG_INF] * num_curr
-        current_segments = []
-
-        # For each current candidate i, choose best previous j maximizing prev_log + log(trans[j][i]) + log(emission[i])
-        for i in range(num_curr):
-            best_log = NEG_INF
-            best_prev_idx = None
-            for j in range(num_prev):
-                trans_p = transition_probs[j][i] if j < len(transition_probs) and i < len(transition_probs[j]) else 0.0
-                if trans_p <= 0.0:
-                    trans_log = NEG_INF
-                else:
-                    trans_log = math.log(trans_p)
-
-                if prev_log_probs[j] == NEG_INF or trans_log == NEG_INF or log_emissions[i] == NEG_INF:
-                    candidate_log = NEG_INF
-                else:
-                    candidate_log = prev_log_probs[j] + trans_log + log_emissions[i]
-
-                if candidate_log > best_log:
-                    best_log = candidate_log
-                    best_prev_idx = j
-
-            # store results for candidate i
-            current_log_probs[i] = best_log
-            new_segment = copy.deepcopy(segments[i])
-            new_segment['previous'] = best_prev_idx
-            # compute direction if best_prev_idx exists
-            if best_prev_idx is not None:
-                new_segment['direction'] = utils.calculate_direction(segments_table[-1][best_prev_idx], new_segment)
-            else:
-                new_segment['direction'] = None
-            current_segments.append(new_segment)
-
-        segments_table.append(current_segments)
-        probabilities_table.append(current_log_probs)
-        dp_index_to_obs_index.append(t_obs_index)  # DP step corresponds to this observation
-
-    # If no DP steps beyond the first were added (edge case), return the single best start candidate
-    if len(probabilities_table) == 0:
-        print("No DP states computed. Aborting.")
-        return None
-
-    # --- Backtrack: find best final dp index (last non-skipped DP step) ---
-    # find last dp index that corresponds to a real DP step (dp_index_to_obs_index not None)
-    last_dp = None
-    for k in range(len(dp_index_to_obs_index)-1, -1, -1):
-        if dp_index_to_obs_index[k] is not None:
-            last_dp = k
-            break
-
-    if last_dp is None:
-        print("ERROR: No valid DP states to backtrack.")
-        return None
-
-    # pick best candidate at final DP
-    last_probs = probabilities_table[last_dp]
-    last_idx, best_val = max(enumerate(last_probs), key=lambda x: x[1])
-
-    # walk back pointers
-    final_path = []
-    cur_dp = last_dp
-    cur_idx = last_idx
-    visited = set()
-    while cur_idx is not None and cur_dp >= 0:
-        # safety: guard indexing errors
-        if cur_dp >= len(segments_table):
-            break
-        segs = segments_table[cur_dp]
-        if cur_idx < 0 or cur_idx >= len(segs):
-            print("Backtracking index out of range; stopping.")
-            break
-
-        segment = segs[cur_idx]
-        final_path.append(segment)
-
-        # detect cycles: if (cur_dp, cur_idx) repeats, break
-        key = (cur_dp, cur_idx)
-        if key in visited:
-            print("Detected cycle during backtracking; stopping.")
-            break
-        visited.add(key)
-
-        # move to previous DP step and index
-        prev_idx = segment.get('previous', None)
-        cur_idx = prev_idx
-        cur_dp -= 1
-
-        # If prev_idx is None, we've reached start — stop.
-        if cur_idx is None:
-            break
-
-    final_path = final_path[::-1]  # reverse
+        log_probs, backpointers = _transition_step(point, new_point, prev_segments, prev_log_probs,
+                                                   segments, emission_probabilities, graph)
+        point = new_point
+        steps.append((segments, log_probs, backpointers, t_obs_index))
+        if prune:
+            n = _adapt_n(_to_log_probs(emission_probabilities), n, min_n, max_n, emission_beam)
+            steps[-1] = _prune_step(steps[-1], beam, n, prune_stats)
+        if sigma_estimator is not None:
+            _update_sigma(sigma_estimator, steps[-1])
+            sigma = sigma_estimator.sigma()
+
+    if sigma_estimator is not None:
+        logger.info(f"Estimated GPS sigma: {sigma:.2f} m")
+    if prune:
+        states = sum(s['states'] for s in prune_stats)
+        pruned = sum(s['pruned'] for s in prune_stats)
+        logger.info(f"Beam pruning dropped {pruned} of {states} states ({100.0 * pruned / max(states, 1):.1f}%)")
+
+    with metrics.timer('backtrack'):
+        final_path = _backtrack(steps)
 
     node_ids = utils.get_node_ids(final_path)
+    if fix_index is not None:
+        node_ids = _expand_node_ids(node_ids, final_path, fix_index, len(observations))
     if filename is not None:
-        print(f"Writing results to {filename}...")
+        logger.info(f"Writing results to {filename}...")
         utils.write_to_file(node_ids, filename)
 
     return node_ids